@@ -2,6 +2,8 @@ import time
 import streamlit as st
 from hydralit import HydraHeadApp
 from hydralit_components import HyLoader, Loaders
+from utils.session_memory import PAGE_STATE_KEYS, get_session_memory, session_memory_report
+from utils.timing import span, collect_spans, export_metrics, timing_report
 
 class MyLoadingApp(HydraHeadApp):
   def __init__(self, title = 'Loader', delay=0,loader=Loaders.standard_loaders, **kwargs):
@@ -41,11 +43,25 @@ z-index: 9999;
       if hasattr(app_target,'title'):
         app_title = app_target.title
 
-      if app_title == 'Loader Playground': # debug purpose
-        app_target.run()
-      else:
-        with HyLoader('', Loaders.pretty_loaders, index=0):
+      # Read back the state of this page if it was spilled to disk while the page was closed
+      memory = get_session_memory()
+      page_keys = PAGE_STATE_KEYS.get(app_title, [])
+      memory.restore(st.session_state, page_keys)
+
+      with collect_spans() as spans, span(f"page.{app_title or 'untitled'}"):
+        if app_title == 'Loader Playground': # debug purpose
           app_target.run()
+        else:
+          with HyLoader('', Loaders.pretty_loaders, index=0):
+            app_target.run()
+      export_metrics()
+
+      # Spill the state of closed pages once the session is over its memory cap
+      memory.enforce(st.session_state, keep=page_keys)
+      if st.session_state.get('ADMIN_MODE'):
+        with st.sidebar:
+          session_memory_report(memory)
+          timing_report(spans)
   
     except Exception as e:
       # st.image("./resources/failure.png",width=100,)
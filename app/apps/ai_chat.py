@@ -2,13 +2,14 @@ import streamlit as st
 from streamlit import session_state as state
 import time
 
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain.schema import HumanMessage, AIMessage
+from langchain.schema import HumanMessage, AIMessage, SystemMessage
 
-from utils.ai_methods import stream_llm_response
-
-CONTEXT_LIMIT = 10
+from utils.ai_methods import stream_llm_response, cached_llm_response, get_chat_llm
+from utils.chat_history import empty_summary, pack_history, fold_history, make_summarize_fn
+from utils.llm_clients import get_llm_client_pool
+from utils.response_cache import get_response_cache
+from utils.streaming import StreamMetrics
+from utils.globals import CHAT_HISTORY_TOKENS
 
 def main():
     if state['selected_model'] in [None, ""]:
@@ -16,32 +17,27 @@ def main():
         return
 
     state['chat_history'] = state.get('chat_history', [])
+    state['chat_summary'] = state.get('chat_summary', empty_summary())
 
-    mascot = 'Agent'
-    model_provider = state['selected_model'].split("/")[0]
-    if model_provider == "openai":
-        llm_stream = ChatOpenAI(
-            api_key=state['OPENAI_API_KEY'],
-            model_name=state['selected_model'].split("/")[1],
-            temperature=0.3,
-            streaming=True,
-        )
-        mascot = 'OpenAI'
-    elif model_provider == "anthropic":
-        llm_stream = ChatAnthropic(
-            api_key=state['ANTHROPIC_API_KEY'],
-            model=state['selected_model'].split("/")[1],
-            temperature=0.3,
-            streaming=True,
-        )
-        mascot = 'Claude'
+    llm_stream, mascot = get_chat_llm(state['selected_model'])
 
     with st.sidebar:
         clear_chat_history = st.button('Clear Chat History', type='primary')
         if clear_chat_history:
             state['chat_history'] = []
+            state['chat_summary'] = empty_summary()
             st.experimental_fragment()
 
+        with st.expander('Context Settings'):
+            history_tokens = st.slider('History token budget', min_value=500, max_value=16000, value=CHAT_HISTORY_TOKENS, step=500)
+            summarize = st.toggle('Summarize older messages', value=True)
+            use_cache = st.toggle('Reuse cached answers', value=True)
+
+        if state.get('ADMIN_MODE'):
+            with st.expander('LLM Clients'):
+                st.write(get_llm_client_pool().stats())
+            with st.expander('Response Cache'):
+                st.write(get_response_cache().stats())
 
     # Display the chat history with separate expanders for each interaction
     user_messages = [msg for msg in state['chat_history'] if msg['role'] == 'user']
@@ -51,7 +47,7 @@ def main():
     interaction_count = min(len(user_messages), len(assistant_messages))
 
     # Display the chat history, starting with the oldest messages
-    st.info(f"Showing only up to {CONTEXT_LIMIT} messages")
+    st.info(f"Sending up to {history_tokens} tokens of recent messages" + (", with a summary of older ones" if summarize else ""))
     for i in range(interaction_count):
         user_message = user_messages[i]
         assistant_message = assistant_messages[i]
@@ -83,12 +79,31 @@ def main():
 
         # Generate assistant response
         with st.chat_message('Assistant'):
-            truncated_chat_history = state['chat_history'][-CONTEXT_LIMIT:]
-            messages = [
+            summary = None
+            if summarize:
+                try:
+                    state['chat_summary'] = fold_history(
+                        state['chat_history'], state['chat_summary'], make_summarize_fn(llm_stream), history_tokens
+                    )
+                    summary = state['chat_summary']
+                except Exception as e:
+                    print(f"Error summarizing chat history: {e}")
+
+            messages = []
+            if summary and summary['content']:
+                messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary['content']}"))
+            messages += [
                 HumanMessage(content=msg['content']) if msg['role'] == 'user' else AIMessage(content=msg['content'])
-                for msg in truncated_chat_history
+                for msg in pack_history(state['chat_history'], history_tokens, summary)
             ]
-            full_response = st.write_stream(stream_llm_response(llm_stream, messages))
+            metrics = StreamMetrics()
+            if use_cache:
+                response_stream = cached_llm_response(llm_stream, messages, state['selected_model'], metrics=metrics)
+            else:
+                response_stream = stream_llm_response(llm_stream, messages, metrics)
+            full_response = st.write_stream(response_stream)
+            if state.get('ADMIN_MODE') and metrics.ttft is not None:
+                st.caption(f"First token {metrics.ttft:.2f}s · {metrics.tokens_per_second:.0f} tokens/s · {metrics.frames} frames")
 
         # Add assistant response to chat history
         if full_response:
@@ -97,7 +112,3 @@ def main():
                 'content': full_response
             })
 
-        # Truncate the chat history to avoid excessive growth
-        if len(state['chat_history']) > CONTEXT_LIMIT * 2:
-            state['chat_history'] = state['chat_history'][-CONTEXT_LIMIT * 2:]
-
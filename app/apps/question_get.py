@@ -4,20 +4,12 @@ import pandas as pd
 import numpy as np
 import json
 
-from utils.text import (
-    normalize_string, 
-    infer_sector_rows,
-    preprocess_data,
-)
-from utils.path_utils import get_file_path
-
-
-# load data as globals
-df = pd.read_csv(get_file_path('cdpq.csv'))
-df.columns = [normalize_string(col) for col in df.columns]
-df = df.replace({np.nan: 'NaN'})  # Replace NaNs with "NaN" string in the dataframe
-sector_df = pd.read_csv(get_file_path('cdpq_sector_codes.csv'), header=0)
-sector_df.columns = [normalize_string(col) for col in sector_df.columns]
+from utils.text import preprocess_data
+from utils.catalog import get_catalog
+from utils.qa_store import as_qa_store, build_qa_store
+from utils.filtering import filter_positions, get_filter_cache
+from utils.timing import timed
+from utils.globals import QUESTIONS_PER_PAGE
 
 
 
@@ -25,7 +17,7 @@ def main():
     state['settings'] = state.get('settings', {})
     state['filtered_df'] = state.get('filtered_df', None)
     state['user_answers'] = state.get('user_answers', {})
-    state['qa_cache'] = state.get('qa_cache', {})
+    state['qa_cache'] = as_qa_store(state.get('qa_cache'))
     state['current_page'] = state.get('current_page', 0)
 
 
@@ -35,7 +27,15 @@ def main():
             st.write(state['settings'])
 
         with st.expander('Cache'):
-            st.write(state['qa_cache'])
+            # counts only, the full cache is not sent to the browser on every rerun
+            answered = int((state['qa_cache']['answer'] != "").sum())
+            st.write(f"Answered {answered} of {len(state['qa_cache'])} questions")
+            if st.toggle('Preview', key='qa_cache_preview'):
+                st.dataframe(state['qa_cache'].head(QUESTIONS_PER_PAGE))
+
+        if state.get('ADMIN_MODE'):
+            with st.expander('Filter Cache'):
+                st.write(get_filter_cache().stats())
 
     t1, t2 = st.tabs(["Get Questions", "Load Settings"])
     with t1:
@@ -57,24 +57,26 @@ def main():
 
 
 def get_question_form():
+    catalog = get_catalog()
+
     # Load previous settings or initialize default
     current_settings = state.get('settings', {})
     
     # Normalize filter values
     sectors = current_settings.get('sectors', [])
-    supply_chain_status = current_settings.get('supply_chain', df['supply_chain_only'].unique().tolist())
-    ifrs_s2_status = current_settings.get('ifrs_s2', df['ifrs_s2'].unique().tolist())
-    afi_status = current_settings.get('afi', df['afi'].unique().tolist())
-    modules = current_settings.get('module_name', df['module_name'].unique().tolist())
+    supply_chain_status = current_settings.get('supply_chain', catalog.get_options('supply_chain_only'))
+    ifrs_s2_status = current_settings.get('ifrs_s2', catalog.get_options('ifrs_s2'))
+    afi_status = current_settings.get('afi', catalog.get_options('afi'))
+    modules = current_settings.get('module_name', catalog.get_options('module_name'))
 
     # Normalize the filter options and the current settings to strings
-    supply_chain_options, supply_chain_status = normalize_filter_values(df, 'supply_chain_only', supply_chain_status)
-    ifrs_s2_options, ifrs_s2_status = normalize_filter_values(df, 'ifrs_s2', ifrs_s2_status)
-    afi_options, afi_status = normalize_filter_values(df, 'afi', afi_status)
-    module_options, modules = normalize_filter_values(df, 'module_name', modules)
+    supply_chain_options, supply_chain_status = normalize_filter_values(catalog, 'supply_chain_only', supply_chain_status)
+    ifrs_s2_options, ifrs_s2_status = normalize_filter_values(catalog, 'ifrs_s2', ifrs_s2_status)
+    afi_options, afi_status = normalize_filter_values(catalog, 'afi', afi_status)
+    module_options, modules = normalize_filter_values(catalog, 'module_name', modules)
 
     # filter widgets
-    sectors = st.multiselect('Select Sectors', sector_df['sector'].unique().tolist(), default=sectors)
+    sectors = st.multiselect('Select Sectors', list(catalog.sector_options), default=sectors)
     supply_chain_status = st.multiselect('Supply Chain Status', supply_chain_options, default=supply_chain_status)
     ifrs_s2_status = st.multiselect('IFRS S2 Status', ifrs_s2_options, default=ifrs_s2_status)
     afi_status = st.multiselect('AFI Status', afi_options, default=afi_status)
@@ -92,10 +94,10 @@ def get_question_form():
     if reset_button:
         state['settings'] = {
             'sectors': [],
-            'supply_chain': df['supply_chain_only'].unique().tolist(),
-            'ifrs_s2': df['ifrs_s2'].unique().tolist(),
-            'afi': df['afi'].unique().tolist(),
-            'module_name': df['module_name'].unique().tolist(),
+            'supply_chain': catalog.get_options('supply_chain_only'),
+            'ifrs_s2': catalog.get_options('ifrs_s2'),
+            'afi': catalog.get_options('afi'),
+            'module_name': catalog.get_options('module_name'),
         }
         st.rerun()
 
@@ -111,7 +113,7 @@ def get_question_form():
         }
 
         # Apply filters using the helper function
-        filtered_df, new_cache = apply_filters(df, sector_df, settings)
+        filtered_df, new_cache = apply_filters(catalog, settings)
 
         # Update global state
         state['filtered_df'] = filtered_df
@@ -132,7 +134,7 @@ def load_get_question_settings():
         state['settings'] = json_content
         
         # Apply filters using the helper function
-        filtered_df, new_cache = apply_filters(df, sector_df, json_content)
+        filtered_df, new_cache = apply_filters(get_catalog(), json_content)
 
         # Update global state
         state['filtered_df'] = filtered_df
@@ -170,16 +172,16 @@ def download_settings_json():
 #---
 
 
-def normalize_filter_values(df, column, default_values):
+def normalize_filter_values(catalog, column, default_values):
     """
     Ensure that the filter options and default values are consistent and only contain strings.
+    Options come precomputed from the catalog.
     Example:
     
-    >>> normalize_filter_values(df, 'sector', [1, 2, np.nan])
-    (['1', '2', 'NaN'], ['1', '2', 'NaN'])
+    >>> normalize_filter_values(catalog, 'afi', [1, 2, np.nan])
+    (['No', 'Yes'], ['1', '2', 'NaN'])
     """
-    options = df[column].unique().tolist()
-    options = [str(val) if val is not np.nan else "NaN" for val in options]
+    options = catalog.get_options(column)
     
     # Ensure default values are also converted to strings
     default_values = [str(val) if val is not np.nan else "NaN" for val in default_values]
@@ -188,57 +190,36 @@ def normalize_filter_values(df, column, default_values):
 
 
 
-def apply_filters(df, sector_df, settings):
+@timed('filter.apply_filters')
+def apply_filters(catalog, settings):
     """
-    Apply filters to the given dataframe based on the settings.
+    Apply filters to the catalog questions based on the settings.
     Returns the filtered dataframe and the updated qa_cache.
     """
+    df = catalog.df
     sectors = settings.get('sectors', [])
-    supply_chain_status = settings.get('supply_chain', df['supply_chain_only'].unique().tolist())
-    ifrs_s2_status = settings.get('ifrs_s2', df['ifrs_s2'].unique().tolist())
-    afi_status = settings.get('afi', df['afi'].unique().tolist())
-    modules = settings.get('module_name', df['module_name'].unique().tolist())
+    supply_chain_status = settings.get('supply_chain', catalog.get_options('supply_chain_only'))
+    ifrs_s2_status = settings.get('ifrs_s2', catalog.get_options('ifrs_s2'))
+    afi_status = settings.get('afi', catalog.get_options('afi'))
+    modules = settings.get('module_name', catalog.get_options('module_name'))
 
     # Normalize the filter options
-    supply_chain_options, supply_chain_status = normalize_filter_values(df, 'supply_chain_only', supply_chain_status)
-    ifrs_s2_options, ifrs_s2_status = normalize_filter_values(df, 'ifrs_s2', ifrs_s2_status)
-    afi_options, afi_status = normalize_filter_values(df, 'afi', afi_status)
-    module_options, modules = normalize_filter_values(df, 'module_name', modules)
-
-    # Filter data based on sector selection
-    if sectors == []:
-        filtered_df = df
-    else:
-        selected_sector_codes = sector_df[sector_df['sector'].isin(sectors)]['sector_code'].tolist()
-        filtered_df = infer_sector_rows(df, selected_sector_codes)
-
-    # Apply other filters based on selection
-    filtered_df = filtered_df[
-        (filtered_df['supply_chain_only'].isin(supply_chain_status)) 
-        & (filtered_df['ifrs_s2'].isin(ifrs_s2_status)) 
-        & (filtered_df['afi'].isin(afi_status))
-        & (filtered_df['module_name'].isin(modules))
-    ]
-
-    # Update qa_cache based on the filtered data
-    new_cache = {}
-    for idx, row in filtered_df.iterrows():
-        question_id = str(row['question_number'])
-        question = row['2024_question']
-        sector = row['sector']
-        module_name = row['module_name']
-
-        # Retain answer if question exists in previous cache
-        if question_id in state['qa_cache']:
-            answer = state['qa_cache'][question_id].get('answer', "")
-        else:
-            answer = ""  # Initialize with empty answer
-        
-        new_cache[question_id] = {
-            'question': question,
-            'sector': sector,
-            'module_name': module_name,
-            'answer': answer
-        }
+    supply_chain_options, supply_chain_status = normalize_filter_values(catalog, 'supply_chain_only', supply_chain_status)
+    ifrs_s2_options, ifrs_s2_status = normalize_filter_values(catalog, 'ifrs_s2', ifrs_s2_status)
+    afi_options, afi_status = normalize_filter_values(catalog, 'afi', afi_status)
+    module_options, modules = normalize_filter_values(catalog, 'module_name', modules)
+
+    # Filter rows, memoized on the resolved settings
+    positions = filter_positions(catalog, {
+        'sectors': sectors,
+        'supply_chain': supply_chain_status,
+        'ifrs_s2': ifrs_s2_status,
+        'afi': afi_status,
+        'module_name': modules,
+    })
+    filtered_df = df.iloc[positions]
+
+    # Update qa_cache based on the filtered data, retaining previous answers
+    new_cache = build_qa_store(filtered_df, state.get('qa_cache'))
 
     return filtered_df, new_cache
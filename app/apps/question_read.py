@@ -1,34 +1,46 @@
 import streamlit as st 
 from streamlit import session_state as state
-import json
 import pandas as pd
-
-from utils.text import (
-    normalize_string, 
-    infer_sector_rows,
-    preprocess_data,
+from datetime import datetime
+
+from utils.catalog import get_catalog
+from utils.filtering import FILTER_COLUMNS, filter_positions
+from utils.qa_store import (
+    as_qa_store,
+    build_qa_store,
+    update_answers,
 )
-from utils.path_utils import get_file_path
-from utils.json_utils import custom_json_decoder
+from utils.qa_save import QAAutosave, encode_save, read_save, read_autosave, restore_qa_store
+from utils.auto_answer import AnswerJob, make_answer_fn, get_answer_jobs
+from utils.search import get_question_index, highlight
+from utils.globals import AUTO_ANSWER_MAX_WORKERS, SEARCH_MAX_RESULTS, QUESTIONS_PER_PAGE, QA_AUTOSAVE_INTERVAL
 
 
 def main():
     state['filtered_df'] = state.get('filtered_df', None)
     state['user_answers'] = state.get('user_answers', {})
-    state['qa_cache'] = state.get('qa_cache', {})
+    state['qa_cache'] = as_qa_store(state.get('qa_cache'))
     state['current_page'] = state.get('current_page', 0)
 
+    # Write back answers drafted in the background before answer widgets are drawn
+    apply_answer_job_results()
+
     with st.sidebar:
         with st.expander('Cache'):
-            st.write(state['qa_cache'])
+            # counts only, the full cache is not sent to the browser on every rerun
+            answered = int((state['qa_cache']['answer'] != "").sum())
+            st.write(f"Answered {answered} of {len(state['qa_cache'])} questions")
+            if st.toggle('Preview', key='qa_cache_preview'):
+                st.dataframe(state['qa_cache'].head(QUESTIONS_PER_PAGE))
 
 
         with st.expander('Save/Load Q&A', expanded=True):
             t1, t2 = st.tabs(['Save', 'Load'])
             with t1:
-                download_qa_json()
+                download_qa_save()
+                autosave_qa()
             with t2:
-                load_qa_json()
+                load_qa_save()
 
     st.info('Load Q&A from sidebar or "Get Questions" tab')
     t1, t2, t3 = st.tabs(["View Questions", "Generate Answers", "Reset"])
@@ -46,84 +58,245 @@ def main():
 
 
 
+@st.fragment
 def view_questions():
-    if state['filtered_df'] is not None:
-        total_questions = len(state['filtered_df'])
-        questions_per_page = 10
-        total_pages = (total_questions // questions_per_page) + (1 if total_questions % questions_per_page else 0)
-
-        # get current questions to display based on current page
-        start_idx = state['current_page'] * questions_per_page
-        end_idx = start_idx + questions_per_page
-        questions_to_display = state['filtered_df'].iloc[start_idx:end_idx]
-
-        # Popover for Pagination Controls
-        with st.popover("Page Navigation"):
-            st.markdown(f"Total questions: {total_questions} | Total pages: {total_pages}")
-
-            # current page
-            with st.form("Go to Page"):
-                manual_page = st.number_input(
-                    "Current page",
-                    min_value=1,
-                    max_value=total_pages,
-                    value=state['current_page'] + 1,  # Starting value should be the current page + 1
-                    step=1,
-                    key="manual_page_input"
-                )
-                change_page_button = st.form_submit_button("Go")
-                
-            # When the page number is changed, update current_page and rerun
-            if change_page_button and manual_page != state['current_page'] + 1:
-                state['current_page'] = manual_page - 1
-                st.rerun()
-            
-            c1, c2, c3 = st.columns([1, 6, 1])  # Empty column for alignment            
-            with c1:
-                if state['current_page'] > 0:
-                    if st.button(':arrow_backward:', key='prev_page'):
-                        state['current_page'] -= 1
-                        st.rerun()
-            
-            with c3:
-                if state['current_page'] < total_pages - 1:
-                    if st.button(':arrow_forward:', key='next_page'):
-                        state['current_page'] += 1
-                        st.rerun()
-
-        # display questions
-        for idx, row in questions_to_display.iterrows():
-            question_id = str(row['question_number'])
-            question = row['2024_question']
-            sector = row['sector']
-            module_name = row['module_name']
-
-            # Initialize each question entry if not already in qa_cache
-            if question_id not in state['qa_cache']:
-                state['qa_cache'][question_id] = {
-                    'question': question,
-                    'sector': sector,
-                    'module_name': module_name,
-                    'answer': ""  # Initialize with empty answer
-                }
-            # Load the existing answer if available, otherwise set to default
-            answer = state['qa_cache'][question_id]['answer']
-
-            with st.expander(f'**Question:** {question_id} | **Sector:** {sector}'):
-                answer = st.text_area(
-                    f'{question}',
-                    value=answer,
-                    key=f"answer_{question_id}",
-                    max_chars=4000
-                )
-                state['qa_cache'][question_id]['answer'] = answer
+    """
+    Paged answer editor of the filtered questions.
+    Only the rows of the current page are sent to the browser, and edits are written
+    to qa_cache as they are made. Page turns and edits rerun this fragment only.
+    """
+    if state['filtered_df'] is None:
+        return
+
+    query = st.text_input(
+        'Search questions',
+        key='question_search',
+        placeholder='Words or question numbers, e.g. "transition plan" or 2.2.1',
+        on_change=commit_pending_edits,
+    )
+    if query.strip():
+        # filtered_df keeps the catalog row positions as its index
+        index = get_question_index(get_catalog().fingerprint)
+        positions, _ = index.search(query, positions=state['filtered_df'].index)
+        questions = state['filtered_df'].loc[positions]
+        st.caption(f"{len(positions)} matching questions" + (" (top results)" if len(positions) == SEARCH_MAX_RESULTS else ""))
+    else:
+        questions = state['filtered_df']
+
+    total_questions = len(questions)
+    total_pages = max(1, -(-total_questions // QUESTIONS_PER_PAGE))
+    state['current_page'] = min(state['current_page'], total_pages - 1)
+
+    # get current questions to display based on current page
+    start_idx = state['current_page'] * QUESTIONS_PER_PAGE
+    questions_to_display = questions.iloc[start_idx:start_idx + QUESTIONS_PER_PAGE]
+
+    # Popover for Pagination Controls
+    with st.popover("Page Navigation"):
+        st.markdown(f"Total questions: {total_questions} | Total pages: {total_pages}")
+
+        # current page
+        with st.form("Go to Page"):
+            st.number_input(
+                "Current page",
+                min_value=1,
+                max_value=total_pages,
+                value=state['current_page'] + 1,  # Starting value should be the current page + 1
+                step=1,
+                key="manual_page_input"
+            )
+            st.form_submit_button("Go", on_click=lambda: go_to_page(state['manual_page_input'] - 1, total_pages))
+
+        c1, c2, c3 = st.columns([1, 6, 1])  # Empty column for alignment
+        with c1:
+            if state['current_page'] > 0:
+                st.button(':arrow_backward:', key='prev_page', on_click=go_to_page, args=(state['current_page'] - 1, total_pages))
+
+        with c3:
+            if state['current_page'] < total_pages - 1:
+                st.button(':arrow_forward:', key='next_page', on_click=go_to_page, args=(state['current_page'] + 1, total_pages))
+
+    # Initialize entries of the displayed questions not yet in qa_cache
+    page_ids = questions_to_display['question_number'].astype(str)
+    missing = ~page_ids.isin(state['qa_cache'].index)
+    if missing.any():
+        state['qa_cache'] = pd.concat([state['qa_cache'], build_qa_store(questions_to_display[missing.to_numpy()])])
+
+    page_cache = state['qa_cache'].loc[page_ids.drop_duplicates().to_numpy()]
+    if query.strip():
+        for question_id, question in zip(page_cache.index, page_cache['question']):
+            st.markdown(f"**{question_id}** {highlight(question, query)}")
+
+    # Edits are written to qa_cache as they are made, so page turns, searches and the
+    # autosave see them. The editor key changes on every commit so committed edits are
+    # not replayed on top of the new answers.
+    state['qa_editor_version'] = state.get('qa_editor_version', 0)
+    state['qa_editor_key'] = f"qa_editor_{state['qa_editor_version']}_{state['current_page']}_{query.strip()}"
+    state['qa_editor_ids'] = list(page_cache.index)
+    st.data_editor(
+        page_cache[['sector', 'question', 'answer']],
+        key=state['qa_editor_key'],
+        on_change=commit_pending_edits,
+        disabled=['sector', 'question'],
+        column_config={
+            '_index': st.column_config.TextColumn('Question', width='small'),
+            'sector': st.column_config.TextColumn('Sector', width='small'),
+            'question': st.column_config.TextColumn('Question text', width='large'),
+            'answer': st.column_config.TextColumn('Answer', width='large', max_chars=4000),
+        },
+        use_container_width=True,
+    )
+
+
+
+
+def commit_pending_edits():
+    """
+    Write the edits of the answer editor into qa_cache, before its key changes.
+    Returns the number of answers changed.
+    """
+    editor_state = state.get(state.get('qa_editor_key'))
+    if not editor_state or not editor_state.get('edited_rows'):
+        return 0
+
+    ids = state['qa_editor_ids']
+    answers = pd.Series(
+        {ids[row]: edits['answer'] for row, edits in editor_state['edited_rows'].items() if 'answer' in edits and row < len(ids)},
+        dtype=object,
+    )
+    changed = update_answers(state['qa_cache'], answers)
+    state['qa_editor_version'] += 1
+    return changed
+
+
 
+def go_to_page(page, total_pages):
+    """
+    Page navigation callback, runs before the rerun so the new page is drawn without an extra rerun.
+    Edits of the current page are committed first, the editor of the new page does not hold them.
+    """
+    commit_pending_edits()
+    state['current_page'] = max(0, min(page, total_pages - 1))
 
 
 
 def generate_answers():
-    st.write('generate answers')
-    pass
+    """
+    Draft answers of every unanswered question in qa_cache with parallel LLM workers,
+    using chunks retrieved from the files uploaded in RAG Chat.
+    The job runs in the background, survives reruns and resumes from the remaining unanswered questions.
+    """
+    job = get_answer_jobs().get(state['session_id'])
+
+    if job is None or job.status in ['done', 'cancelled']:
+        start_answer_job()
+    if job is not None:
+        answer_job_progress()
+
+
+
+def start_answer_job():
+    """
+    Unanswered question count, summary of the last run and controls of a new answer job.
+    """
+    summary = state.get('answer_job_summary')
+    if summary is not None:
+        st.caption(f"Last run {summary['status']}: {summary['done']}/{summary['total']} questions")
+        if summary['errors']:
+            with st.expander(f"Errors ({len(summary['errors'])})"):
+                st.write(summary['errors'])
+
+    unanswered = state['qa_cache'][state['qa_cache']['answer'] == ""]
+    st.write(f"Unanswered questions: {len(unanswered)}")
+
+    if state.get('selected_model') in [None, ""]:
+        st.error('Please input your API key and select a model')
+        return
+    if state.get('vector_db') is None:
+        st.warning('No files uploaded in RAG Chat, answers will be drafted without context')
+
+    max_workers = st.slider('Parallel workers', min_value=1, max_value=16, value=AUTO_ANSWER_MAX_WORKERS)
+    if st.button('Generate Answers', disabled=unanswered.empty):
+        from utils.ai_methods import get_chat_llm, sync_vector_db
+        from utils.vector_store import get_collection_manager
+
+        # keep the collection alive, and pinned against eviction until the job is done
+        sync_vector_db()
+        vector_db = state.get('vector_db')
+        on_done = None
+        if vector_db is not None:
+            manager, session_id = get_collection_manager(), state['session_id']
+            manager.pin(session_id)
+            on_done = lambda: manager.unpin(session_id)
+
+        llm, _ = get_chat_llm(state['selected_model'], temperature=0.2)
+        answer_fn = make_answer_fn(llm, vector_db)
+        questions = zip(unanswered.index, unanswered['question'])
+        state['answer_job_summary'] = None
+        get_answer_jobs()[state['session_id']] = AnswerJob(questions, answer_fn, max_workers, on_done=on_done).start()
+        st.rerun()
+
+
+
+@st.fragment(run_every=2)
+def answer_job_progress():
+    """
+    Progress of the session answer job, refreshed every 2 seconds.
+    Triggers a full rerun when new answers are ready to be written back, and drops
+    the job once it is finished or cancelled and its answers are written back.
+    """
+    job = get_answer_jobs().get(state['session_id'])
+    if job is None:
+        return
+
+    done = job.completed + len(job.errors)
+    st.progress(done / max(job.total, 1), text=f"{job.status.capitalize()}: {done}/{job.total} questions")
+
+    if job.status == 'running':
+        if st.button('Cancel', key='cancel_answer_job'):
+            job.cancel()
+    if job.status in ['cancelling', 'done', 'cancelled']:
+        finish_answer_job(job)
+        st.rerun()
+    if job.errors:
+        with st.expander(f'Errors ({len(job.errors)})'):
+            st.write(job.errors)
+
+    if job.has_results():
+        st.rerun()
+
+
+
+def finish_answer_job(job):
+    """
+    Write back the last answers of a finished or cancelled answer job and drop it,
+    keeping a summary of the run. Calls still in flight after a cancel are discarded.
+    """
+    apply_answer_job_results()
+    state['answer_job_summary'] = {
+        'status': 'cancelled' if job.status in ['cancelling', 'cancelled'] else 'done',
+        'done': job.completed + len(job.errors),
+        'total': job.total,
+        'errors': dict(job.errors),
+    }
+    jobs = get_answer_jobs()
+    if jobs.get(state['session_id']) is job:
+        del jobs[state['session_id']]
+
+
+
+def apply_answer_job_results():
+    """
+    Write answers completed by the session answer job into qa_cache.
+    Answers typed by the user in the meantime are kept.
+    """
+    job = get_answer_jobs().get(state.get('session_id'))
+    if job is None:
+        return
+
+    for question_id, answer in job.drain_results().items():
+        if question_id in state['qa_cache'].index and state['qa_cache'].at[question_id, 'answer'] == "":
+            state['qa_cache'].at[question_id, 'answer'] = answer
 
 
 
@@ -132,8 +305,7 @@ def generate_answers():
 def reset_answers():
     reset_button = st.button('Reset Answers')
     if reset_button:
-        for question_id, entry in state['qa_cache'].items():
-            state['qa_cache'][question_id]['answer'] = ""
+        state['qa_cache']['answer'] = ""
 
         st.success('Answers reset successfully')
         st.rerun()
@@ -141,80 +313,102 @@ def reset_answers():
 
 
 
-def download_qa_json():
-    # rerun first to get latest change
-    qa_data = {
-        'settings': {
-            'sectors': state.get('settings', {}).get('sectors', []),
-            'supply_chain': state.get('settings', {}).get('supply_chain', []),
-            'ifrs_s2': state.get('settings', {}).get('ifrs_s2', []),
-            'afi': state.get('settings', {}).get('afi', []),
-            'module_name': state.get('settings', {}).get('module_name', []),
-        },
-        'qa': [
-            {'question_id': question_id, 'question': entry['question'], 'answer': entry['answer']}
-            for question_id, entry in state['qa_cache'].items()
-        ]
-    }
-    
-    # Preprocess the data to ensure it is JSON-safe
-    qa_data['settings'] = preprocess_data(qa_data['settings'])
-    qa_data['qa'] = [preprocess_data(entry) for entry in qa_data['qa']]
-    
-    st.download_button(
-        label="Download Q/A as JSON",
-        data=json.dumps(qa_data, indent=4),
-        file_name="qa_data.json",
-        mime="application/json",
-    )
+def qa_settings():
+    """Filter settings written to Q&A save files."""
+    settings = state.get('settings', {})
+    return {key: settings.get(key, []) for key in ['sectors', *FILTER_COLUMNS]}
+
+
+
+def download_qa_save():
+    """
+    Save file of the answered questions, only built when requested.
+    """
+    if st.button('Prepare save file'):
+        state['qa_save_file'] = encode_save(state['qa_cache'], qa_settings(), get_catalog().fingerprint)
+        state['qa_save_time'] = datetime.now().strftime('%H:%M:%S')
+
+    if state.get('qa_save_file') is not None:
+        st.download_button(
+            label="Download Q/A",
+            data=state['qa_save_file'],
+            file_name="qa_data.ndjson.gz",
+            mime="application/gzip",
+        )
+        st.caption(f"Prepared at {state['qa_save_time']} ({len(state['qa_save_file']) / 1024:.1f} KB)")
+
 
 
+@st.fragment(run_every=QA_AUTOSAVE_INTERVAL)
+def autosave_qa():
+    """
+    Append the answers changed since the last autosave to the journal of the session.
+    The session id is the recovery code of the journal.
+    """
+    if state.get('qa_autosave') is None:
+        state['qa_autosave'] = QAAutosave(state['session_id'])
+    autosave = state['qa_autosave']
 
-def load_qa_json():
-    """Load Q&A data from a file."""
+    try:
+        autosave.write(state['qa_cache'], qa_settings(), get_catalog().fingerprint)
+    except OSError as e:
+        st.caption(f"Autosave failed: {e}")
+        return
+
+    if autosave.last_write is not None:
+        st.caption(f"Autosaved at {datetime.fromtimestamp(autosave.last_write).strftime('%H:%M:%S')}, recovery code:")
+        st.code(autosave.recovery_code, language=None)
+
+
+
+def load_qa_save():
+    """Load Q&A data from a save file, a legacy JSON save file or an autosave."""
     with st.form("Load Q&A"):
-        qa_file = st.file_uploader('Upload Q/A save file', accept_multiple_files=False, type=['json'])
+        qa_file = st.file_uploader('Upload Q/A save file', accept_multiple_files=False, type=['gz', 'ndjson', 'json'])
+        recovery_code = st.text_input('Or restore an autosave', placeholder='Recovery code')
         submit_button = st.form_submit_button("Load Q&A")
-        
-    if submit_button:
-        if qa_file is not None:
-            # Load the JSON data from the uploaded file
-            qa_data = json.load(qa_file)
-            
-            # Extract settings and apply them to the state
-            settings = qa_data.get('settings', {})
-            state['settings'] = settings
 
-            # Rebuild the filtered dataframe based on loaded settings
-            qa_entries = qa_data.get('qa', [])
-            state['qa_cache'] = {entry['question_id']: entry for entry in qa_entries}
+    if state.get('qa_load_warning'):
+        st.warning(state.pop('qa_load_warning'))
 
-            # Rebuild the filtered dataframe
-            rebuild_filtered_df(settings)
-
-            # Show success message and rerun
-            st.success("Q&A data loaded successfully!")
-            st.rerun()
+    if submit_button:
+        if qa_file is not None:
+            header, qa_entries = read_save(qa_file.getvalue())
+        elif recovery_code.strip():
+            saved = read_autosave(recovery_code.strip())
+            if saved is None:
+                st.error('No autosave found for this recovery code')
+                return
+            header, qa_entries = saved
+        else:
+            return
+
+        # Extract settings and apply them to the state
+        settings = header.get('settings', {})
+        state['settings'] = settings
+
+        # Rebuild the filtered dataframe, then the Q&A store with the saved answers
+        rebuild_filtered_df(settings)
+        catalog = get_catalog()
+        state['qa_cache'] = restore_qa_store(qa_entries, state['filtered_df'], catalog.df)
+        state['qa_editor_version'] = state.get('qa_editor_version', 0) + 1
+        state['qa_save_file'] = None
+
+        if header.get('catalog') not in [None, catalog.fingerprint]:
+            state['qa_load_warning'] = 'Save file was made with a different question catalog, questions missing from it keep their saved answer only'
+
+        # Show success message and rerun
+        st.success("Q&A data loaded successfully!")
+        st.rerun()
 
 
 
 def rebuild_filtered_df(settings):
     """Rebuild the filtered dataframe based on the loaded settings."""
-    df = pd.read_csv(get_file_path('cdpq.csv'))
-    df.columns = [normalize_string(col) for col in df.columns]
-    sector_df = pd.read_csv(get_file_path('cdpq_sector_codes.csv'), header=0)
-    sector_df.columns = [normalize_string(col) for col in sector_df.columns]
-
-    # Reapply filters
-    filtered_df = df[
-        (df['supply_chain_only'].isin(settings.get('supply_chain', []))) 
-        & (df['ifrs_s2'].isin(settings.get('ifrs_s2', []))) 
-        & (df['afi'].isin(settings.get('afi', [])))
-        & (df['module_name'].isin(settings.get('module_name', [])))
-    ]
-
-    if settings.get('sectors', []):
-        selected_sector_codes = sector_df[sector_df['sector'].isin(settings['sectors'])]['sector_code'].tolist()
-        filtered_df = infer_sector_rows(filtered_df, selected_sector_codes)
-
-    state['filtered_df'] = filtered_df
\ No newline at end of file
+    catalog = get_catalog()
+
+    # Reapply filters, unset filters select nothing
+    resolved_settings = {key: settings.get(key, []) for key in ['sectors', *FILTER_COLUMNS]}
+    positions = filter_positions(catalog, resolved_settings)
+
+    state['filtered_df'] = catalog.df.iloc[positions]
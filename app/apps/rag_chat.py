@@ -4,17 +4,31 @@ from streamlit import session_state as state
 import time
 import random
 
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain.schema import HumanMessage, AIMessage
-import chromadb.api
+from langchain.schema import HumanMessage, AIMessage, SystemMessage
 
 from utils.ai_methods import (
     stream_llm_response,
+    cached_llm_response,
     upload_form_for_rag,
     load_doc_to_db,
-    initialize_vector_db,
+    sync_vector_db,
+    clear_vector_db,
+    get_chat_llm,
+    release_upload,
+    IngestedFile,
 )
+from utils.retrieval import (
+    retrieve,
+    pack_context,
+    get_query_embedding_cache,
+    get_retrieval_cache,
+    RAG_SYSTEM_PROMPT,
+)
+from utils.response_cache import get_response_cache
+from utils.streaming import StreamMetrics
+from utils.globals import RAG_TOP_K
+
+CONTEXT_LIMIT = 6
 
 def main():
     if state['selected_model'] in [None, ""]:
@@ -23,48 +37,119 @@ def main():
     
     state['uploaded_files'] = state.get('uploaded_files', [])
     state['processed_files'] = state.get('processed_files', [])
-    state['vector_db'] = state.get('vector_db', None)
+    sync_vector_db()
     
     with st.sidebar:
         clear_uploads = st.button('Clear Uploads', type='primary')
         if clear_uploads:
+            for file in state['uploaded_files']:
+                if not isinstance(file, IngestedFile):
+                    release_upload(file)
             state['uploaded_files'] = []
-            state['processed_files'] = []
+            clear_vector_db()
             st.rerun()
 
+        clear_chat_history = st.button('Clear Chat History')
+        if clear_chat_history:
+            state['rag_chat_history'] = []
+            st.experimental_fragment()
+
         inspect_chroma()
 
+        if state.get('ADMIN_MODE'):
+            with st.expander('Retrieval Cache'):
+                st.write({
+                    'query_embeddings': get_query_embedding_cache().stats(),
+                    'results': get_retrieval_cache().stats(),
+                    'responses': get_response_cache().stats(),
+                })
+
 
     with st.expander('Uploaded Files', expanded=True):
         upload_form_for_rag()
 
     load_doc_to_db()
 
+    rag_chat()
+
+
+
+def rag_chat():
+    """
+    Chat with the uploaded files: retrieve top k chunks, pack them in the prompt and stream the answer.
+    """
+    state['rag_chat_history'] = state.get('rag_chat_history', [])
+    llm_stream, mascot = get_chat_llm(state['selected_model'])
+
+    with st.sidebar:
+        with st.expander('Retrieval Settings'):
+            top_k = st.slider('Chunks per question', min_value=1, max_value=20, value=RAG_TOP_K)
+            use_mmr = st.toggle('Diversify chunks (MMR)', value=True)
+            use_cache = st.toggle('Reuse cached answers', value=True)
+
+    for msg in state['rag_chat_history']:
+        with st.chat_message('User' if msg['role'] == 'user' else 'Assistant'):
+            st.markdown(msg['content'])
+
+    if state['vector_db'] is None:
+        st.info('Upload files to chat with them')
+        return
+
+    if user_query := st.chat_input(f'Ask {mascot} about your files', max_chars=4000):
+        with st.chat_message('User'):
+            st.markdown(user_query)
+
+        with st.chat_message('Assistant'):
+            docs = retrieve(state['vector_db'], user_query, k=top_k, use_mmr=use_mmr)
+            context = pack_context(docs)
+
+            truncated_chat_history = state['rag_chat_history'][-CONTEXT_LIMIT:]
+            messages = [SystemMessage(content=RAG_SYSTEM_PROMPT.format(context=context))]
+            messages += [
+                HumanMessage(content=msg['content']) if msg['role'] == 'user' else AIMessage(content=msg['content'])
+                for msg in truncated_chat_history
+            ]
+            messages.append(HumanMessage(content=user_query))
+            metrics = StreamMetrics()
+            if use_cache:
+                # the query embedding is already cached by retrieve(), so near duplicate lookups are free
+                embedding = state['vector_db']._embedding_function
+                response_stream = cached_llm_response(llm_stream, messages, state['selected_model'], embedding, metrics=metrics)
+            else:
+                response_stream = stream_llm_response(llm_stream, messages, metrics)
+            full_response = st.write_stream(response_stream)
+            if state.get('ADMIN_MODE') and metrics.ttft is not None:
+                st.caption(f"First token {metrics.ttft:.2f}s · {metrics.tokens_per_second:.0f} tokens/s · {metrics.frames} frames")
+
+            with st.expander(f'Sources ({len(docs)})'):
+                for i, doc in enumerate(docs):
+                    st.caption(f"[{i + 1}] {doc.metadata.get('source', 'unknown')}")
+                    st.text(doc.page_content[:500])
+
+        state['rag_chat_history'].append({'role': 'user', 'content': user_query})
+        if full_response:
+            state['rag_chat_history'].append({'role': 'assistant', 'content': full_response})
+
 
 
 def inspect_chroma():
     """
-    Inspects content of chunked files in vector db in st.expander
+    Inspects content of chunked files of the session collection in st.expander
     """
     if state['vector_db'] is not None:
-        chroma_client = state['vector_db']._client
-        collection_names = [col.name for col in chroma_client.list_collections()]
-        
-        for collection_name in collection_names:
-            # Fetch collection details
-            collection = chroma_client.get_collection(collection_name)
-            documents = collection.get()  # Retrieves vectors and metadata
-            num_vectors = len(documents['documents'])
-            
-            with st.expander(f"Inspect VDB: {collection_name} (Vectors: {num_vectors})", expanded=False):
-                if num_vectors == 0:
-                    st.write("No vectors in this collection.")
-
-                else:
-                    sample = min(5, num_vectors)
-                    random_vectors = random.sample(range(num_vectors), sample)
-
-                    for i, idx in enumerate(random_vectors):  # Limit to first 5 for brevity
-                        st.divider()
-                        st.write(f"Sample {i + 1}:")
-                        st.code(documents['documents'][idx]) 
+        collection = state['vector_db']._collection
+        num_vectors = collection.count()
+
+        with st.expander(f"Inspect VDB: {collection.name} (Vectors: {num_vectors})", expanded=False):
+            if num_vectors == 0:
+                st.write("No vectors in this collection.")
+
+            else:
+                sample = min(5, num_vectors)
+                random_vectors = random.sample(range(num_vectors), sample)
+
+                for i, idx in enumerate(random_vectors):  # Limit to 5 for brevity
+                    documents = collection.get(limit=1, offset=idx, include=['documents'])
+                    st.divider()
+                    st.write(f"Sample {i + 1}:")
+                    st.code(documents['documents'][0])
\ No newline at end of file
@@ -1,64 +1,93 @@
 import streamlit as st
 from streamlit import session_state as state
 
-import os
-import random
-import hashlib
-from time import time
-
-from langchain_community.document_loaders import (
-    CSVLoader,
-    Docx2txtLoader,
-    PDFMinerLoader,
-    TextLoader,
-)
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
+from dataclasses import dataclass
+
 
+# LangChain, OpenAI, Anthropic and Chroma are imported inside the functions that use them,
+# so pages importing this module only pay for them once they actually need them.
 
-from utils.globals import MAX_TOTAL_FILE_SIZE
+from utils.globals import (
+    MAX_TOTAL_FILE_SIZE,
+    EMBEDDING_BASE_URL,
+)
+from utils.ingest_cache import file_digest
+from utils.ingest_jobs import IngestJob, get_ingest_jobs
+from utils.vector_store import get_collection_manager
+from utils.retrieval import embed_query
+from utils.response_cache import get_response_cache, context_hash, replay_response
+from utils.streaming import StreamMetrics, chunk_text, coalesce_stream
+from utils.timing import record_span
 
 
 
-def stream_llm_response(llm_stream, messages):
+def stream_llm_response(llm_stream, messages, metrics=None):
     """
-    Stream the response from the LLM.
+    Stream the response from the LLM, coalesced into frames of text.
     :param llm_stream: LLM stream
         Example: ChatOpenAI(model="gpt-4o-mini", temperature=0.3, streaming=True)
 
     :param messages: Messages to stream
         Example: [{"role": "user", "content": "Hello!"}]
+    :param metrics: StreamMetrics recording time to first token and tokens per second, optional
     """
-    response_message = ""
+    metrics = metrics if metrics is not None else StreamMetrics()
+    texts = (chunk_text(chunk) for chunk in llm_stream.stream(messages))
+    yield from coalesce_stream(texts, metrics)
 
-    for chunk in llm_stream.stream(messages):
-        response_message += chunk.content
-        yield chunk
+    model = getattr(llm_stream, 'model_name', None) or getattr(llm_stream, 'model', None)
+    if metrics.ttft is not None:
+        record_span('llm.first_token', metrics.ttft, model=model)
+        record_span('llm.stream', metrics.finished_at - metrics.started_at, model=model, tokens=metrics.tokens)
 
 
-# Helper: File loader mapping
-def get_loader(file_path, file_type, file_name):
+def cached_llm_response(llm_stream, messages, model, embedding=None, metrics=None):
     """
-    Load the appropriate file loader based on the file type.
-    :param file_path: Path to the file
-        Example: "C:/Users/user/Desktop/file.pdf"
-    :param file_type: File type
-        Example: "application/pdf"
-    :param file_name: File name
-        Example: "file.pdf"
+    Stream the response from the LLM through the process wide response cache.
+    The last message is the prompt, the messages before it are its context.
+    Cached answers are replayed as a stream without calling the provider.
+    :param llm_stream: LLM stream
+    :param messages: LangChain messages, ending with the user prompt
+    :param model: Selected model
+        Example: "openai/gpt-4o-mini"
+    :param embedding: Embedding model matching near duplicate prompts, None for exact matches only
+    :param metrics: StreamMetrics recording the stream, optional
+    """
+    metrics = metrics if metrics is not None else StreamMetrics()
+    cache = get_response_cache()
+    model = f"{model}@{getattr(llm_stream, 'temperature', None)}"
+    prompt = messages[-1].content
+    context = context_hash(messages[:-1])
+    prompt_embedding = embed_query(embedding, prompt) if embedding is not None else None
+
+    response = cache.get(model, prompt, context, prompt_embedding)
+    if response is not None:
+        yield from coalesce_stream(replay_response(response), metrics)
+        return
+
+    yield from stream_llm_response(llm_stream, messages, metrics)
+    if metrics.chunks:
+        cache.put(model, prompt, context, metrics.text, prompt_embedding)
 
+
+def get_chat_llm(selected_model, temperature=0.3):
+    """
+    Streaming chat model of the selected model, with its display name.
+    Models are shared through the process wide client pool, so reruns reuse open connections.
+    :param selected_model: "<provider>/<model>"
+        Example: "openai/gpt-4o-mini"
     """
-    if file_type == "application/pdf":
-        return PDFMinerLoader(file_path)
-    elif file_name.endswith(".docx"):
-        return Docx2txtLoader(file_path)
-    elif file_type in ["text/plain", "text/markdown"]:
-        return TextLoader(file_path)
-    elif file_name.endswith(".csv"):
-        return CSVLoader(file_path, encoding="utf-8")
+    from utils.llm_clients import get_llm_client_pool
+
+    model_provider, model_name = selected_model.split("/", 1)
+    if model_provider == "openai":
+        api_key, mascot = state['OPENAI_API_KEY'], 'OpenAI'
+    elif model_provider == "anthropic":
+        api_key, mascot = state['ANTHROPIC_API_KEY'], 'Claude'
     else:
-        return None
+        raise ValueError(f"Unknown model provider: {model_provider}")
+    llm_stream = get_llm_client_pool().get(model_provider, model_name, api_key, temperature)
+    return llm_stream, mascot
 
 
 def upload_form_for_rag():
@@ -80,9 +109,10 @@ def upload_form_for_rag():
 
         if submit_button and uploaded_files:
             total_size = sum(file.size for file in state['uploaded_files'])
+            file_ids = {file.file_id for file in state['uploaded_files']}
 
             for file in uploaded_files:
-                if file in state['uploaded_files']:
+                if file.file_id in file_ids:
                     st.warning(f"File {file.name} already exists")
                     continue
 
@@ -92,146 +122,230 @@ def upload_form_for_rag():
                 
                 state['uploaded_files'].append(file)
                 total_size += file.size
-            
 
 
 
+@dataclass
+class IngestedFile:
+    """
+    Upload whose bytes were released once it was ingested.
+    Stands in for the UploadedFile in state['uploaded_files'].
+    """
+    name: str
+    type: str
+    size: int
+    file_id: str
+    digest: str
+
 
-def get_document_hash(doc):
+def release_upload(file, digest=None):
     """
-    Generate a hash for a document based on its content and metadata.
-    Example:
-        doc = Document(page_content="Hello, world!", metadata={"source": "file.txt"})
-        get_document_hash(doc)
-        "b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9_9b056818c0ac0d378d3f81d0"
+    Drop the bytes of an upload, held by the UploadedFile and by the Streamlit upload manager.
+    Returns the IngestedFile standing in for it.
     """
-    content_hash = hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest()
-    metadata_hash = hashlib.sha256(str(doc.metadata).encode('utf-8')).hexdigest()
-    return f"{content_hash}_{metadata_hash}"
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    if ctx is not None and getattr(ctx, 'uploaded_file_mgr', None) is not None:
+        ctx.uploaded_file_mgr.remove_file(ctx.session_id, file.file_id)
+    ingested = IngestedFile(file.name, file.type, file.size, file.file_id, digest)
+    file.close()
+    return ingested
+
+
+
+
+def get_embedding_model(max_retries=2):
+    """
+    Embedding model used to index uploads in the vector db.
+    Set OPENAI_EMBEDDING_BASE_URL to use another OpenAI compatible server, e.g. a local fake.
+
+    :param max_retries: Retries of the OpenAI client itself
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    if EMBEDDING_BASE_URL:
+        return OpenAIEmbeddings(
+            api_key=state['OPENAI_API_KEY'],
+            base_url=EMBEDDING_BASE_URL,
+            max_retries=max_retries,
+            check_embedding_ctx_length=False,
+        )
+    return OpenAIEmbeddings(api_key=state['OPENAI_API_KEY'], max_retries=max_retries)
 
 
 
 def load_doc_to_db():
     """
-    From session state, load uploaded files as chunks, embed and index in vdb
+    From session state, queue uploaded files for ingestion in the background and show their progress.
+
+    Files are parsed, chunked, embedded and indexed by the IngestJob of the session,
+    so the page stays responsive and ingestion goes on across reruns.
+    Files are content addressed: parsed chunks and embeddings of files seen before,
+    under any name or session, are read from the ingestion cache instead of recomputed.
     """
     state['uploaded_files'] = state.get('uploaded_files', [])
     state['processed_files'] = state.get('processed_files', [])
+    state['failed_files'] = state.get('failed_files', {})
     if state['uploaded_files'] == []:
         return
-    
-    docs = []
-    for file in state['uploaded_files']:
-        if file.name in state['processed_files']:
-            continue  # Skip already processed files
 
-        try:
-            # save file temporarily
-            os.makedirs('uploads', exist_ok=True)
-            file_path = os.path.join('uploads', file.name)
-            with open(file_path, 'wb') as f:
-                f.write(file.read())
+    if state['OPENAI_API_KEY'] in [None, ""]:
+        st.error("Please set your OpenAI API key in the settings tab.")
+        return
 
-            # load uploaded document from temp file
-            loader = get_loader(file_path, file.type, file.name)
-            if loader is None:
-                st.warning(f"Unable to load {file.name}. Unsupported file type of {file.type}")
-                continue
+    job = get_ingest_jobs().get(state['session_id'])
+    for i, file in enumerate(state['uploaded_files']):
+        if isinstance(file, IngestedFile):
+            continue
+        digest = file_digest(file.getbuffer())  # hashed in place, without copying the upload
+        if digest in state['processed_files']:
+            state['uploaded_files'][i] = release_upload(file, digest)  # indexed, the bytes are no longer needed
+            continue
+        if digest in state['failed_files'] or (job is not None and job.has(digest)):
+            continue  # Skip failed and queued files
+        job = get_ingest_job()
+        job.submit(file.name, file.type, file.getvalue(), digest)
+
+    ingest_progress()
+
+    job = get_ingest_jobs().get(state['session_id'])  # dropped by ingest_progress once idle
+    loaded_chunks = state.get('loaded_chunks', 0) + (job.loaded_chunks if job is not None else 0)
+    sampled_chunks = list(job.sampled_chunks) if job is not None and job.sampled_chunks else state.get('sampled_chunks', [])
+    if sampled_chunks:
+        with st.expander('Loaded Documents', expanded=False):
+            st.write(f"Total Document Chunks: {loaded_chunks}")
+            for chunk in sampled_chunks:  # Display up to 5 random chunks
+                st.divider()
+                st.code(chunk.page_content)
+                st.code(chunk.metadata)
+
+
+
+def get_ingest_job():
+    """
+    Ingestion job of the session, created with the session vector db on first use.
+    """
+    state['processed_chunks'] = state.get('processed_chunks', set())
+    if state['vector_db'] is None:
+        state['vector_db'] = initialize_vector_db()
+
+    jobs = get_ingest_jobs()
+    job = jobs.get(state['session_id'])
+    if job is None or job.vector_db is not state['vector_db']:
+        embedding = get_embedding_model(max_retries=0)  # rate limits are retried by embed_in_batches
+        job = jobs[state['session_id']] = IngestJob(
+            state['session_id'], state['vector_db'], embedding, state['processed_chunks']
+        )
+    return job
 
-            # add to docs and state
-            new_docs = loader.load()
-            docs.extend(new_docs)
 
-            # Mark file as processed
-            state['processed_files'].append(file.name)
-            st.toast(f"Loaded {file.name} to database")
 
-        except Exception as e:
-            st.error(f"Error loading {file.name}: {e}")
-            print(f"Error loading {file.name}: {e}")
-        
-        finally:
-            # remove temporary file
-            os.remove(file_path)
-    
-    if docs:
-        split_and_load_docs(docs)
+def finish_ingest_job(job):
+    """
+    Drop an idle, drained ingestion job of the session, keeping its failed files and
+    sampled chunks in the session state.
+    """
+    for entry in job.status():
+        if entry['status'] == 'error':
+            state['failed_files'][entry['digest']] = (entry['name'], entry['error'])
+    state['loaded_chunks'] = state.get('loaded_chunks', 0) + job.loaded_chunks
+    if job.sampled_chunks:
+        state['sampled_chunks'] = list(job.sampled_chunks)
+    jobs = get_ingest_jobs()
+    if jobs.get(state['session_id']) is job:
+        del jobs[state['session_id']]
 
 
 
-    
+def stop_ingest_job():
+    """
+    Cancel the ingestion job of the session, e.g. once its vector db is deleted.
+    """
+    job = get_ingest_jobs().pop(state['session_id'], None)
+    if job is not None:
+        job.cancel()
 
 
 
+@st.fragment(run_every=1)
+def ingest_progress():
+    """
+    Status of the files being ingested, refreshed every second.
+    Applies the results of the ingestion job to the session state, drops the job once
+    it is idle, and reruns the page once files are loaded.
+    """
+    for name, error in state.get('failed_files', {}).values():
+        st.error(f"Error loading {name}: {error}")
 
+    jobs = get_ingest_jobs()
+    job = jobs.get(state['session_id'])
+    if job is None:
+        return
 
-def initialize_vector_db(docs):
-    """
-    Initializes the vector database using Chroma.
-    Chroma is non persistent, so we need to initialize it every time we run the app.
+    for entry in job.status():
+        if entry['status'] == 'error':
+            st.error(f"Error loading {entry['name']}: {entry['error']}")
+        elif entry['status'] in ['queued', 'parsing', 'embedding']:
+            st.caption(f"Loading {entry['name']}: {entry['status']}, {entry['chunks']} chunks")
 
-    docs: List[Document]
+    # checked before draining, files finishing in between are drained by the next run
+    idle = not job.is_active()
+    done, new_chunks = job.drain_done()
+    state['processed_chunks'].update(new_chunks)
+    if idle:
+        finish_ingest_job(job)
+
+    if done:
+        state['processed_files'].extend(done)
+        st.toast(f"Loaded {len(done)} file(s) to database")
+        st.rerun()
+
+
+
+def initialize_vector_db():
+    """
+    Opens the Chroma collection of the session, created on first use and reused across reruns.
+    Collections are persisted in chroma_db and evicted by the CollectionManager once idle.
     """
     if state['OPENAI_API_KEY'] in [None, ""]:
         st.error("Please set your OpenAI API key in the settings tab.")
         return
-    
-    embedding = OpenAIEmbeddings(api_key=state['OPENAI_API_KEY'])
-    vector_db = Chroma.from_documents(
-        documents=docs,
-        embedding=embedding,
-        persist_directory='chroma_db',
-        collection_name=f"{str(time()).replace('.', '')[:14]}_" + state['session_id'],
-    )
-
-    # We need to manage the number of collections that we have in memory, we will keep the last 20
-    chroma_client = vector_db._client
-    collection_names = sorted([collection.name for collection in chroma_client.list_collections()])
-    print("Number of collections:", len(collection_names))
-    while len(collection_names) > 20:
-        chroma_client.delete_collection(collection_names[0])
-        collection_names.pop(0)
 
-    return vector_db
+    return get_collection_manager().open(state['session_id'], get_embedding_model())
 
 
 
-def split_and_load_docs(docs):
+def sync_vector_db():
     """
+    Keep the session vector db alive on each rerun.
+    If its collection was evicted while the session was idle, reset the ingestion state.
     """
-    if 'processed_chunks' not in state:
+    state['vector_db'] = state.get('vector_db', None)
+    if state['vector_db'] is None:
+        return
+
+    if not get_collection_manager().touch(state['session_id']):
+        st.warning("Your uploads were cleared after a long inactivity, please upload them again.")
+        stop_ingest_job()
+        state['vector_db'] = None
+        state['processed_files'] = []
         state['processed_chunks'] = set()
+        state['failed_files'] = {}
+        state['loaded_chunks'] = 0
+        state['sampled_chunks'] = []
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=5000,
-        chunk_overlap=1000,
-    )
-    document_chunks = text_splitter.split_documents(docs)
-
-    unique_chunks = []
-    for chunk in document_chunks:
-        chunk_hash = get_document_hash(chunk)
-        if chunk_hash not in state['processed_chunks']:
-            state['processed_chunks'].add(chunk_hash)
-            unique_chunks.append(chunk)
-
-    with st.expander('Loaded Documents', expanded=False):
-        total_chunks = len(unique_chunks)
-        st.write(f"Total Document Chunks: {total_chunks}")
-
-        sample = min(5, total_chunks)
-        random_chunks = random.sample(range(total_chunks), sample)
-        for i, chunk in enumerate(random_chunks):  # Display first 5 chunks
-            st.divider()
-            st.code(unique_chunks[chunk].page_content)
-            st.code(unique_chunks[chunk].metadata)
-
-    if unique_chunks:
-        print("Adding new chunks to vector store")
-        if state['vector_db'] == None:
-            state.vector_db = initialize_vector_db(unique_chunks)
-        else:
-            state.vector_db.add_documents(unique_chunks)
-    else:
-        print("No new chunks to add to vector store")
 
+
+def clear_vector_db():
+    """
+    Delete the session vector db and reset the ingestion state.
+    """
+    stop_ingest_job()
+    get_collection_manager().release(state['session_id'])
+    state['vector_db'] = None
+    state['processed_files'] = []
+    state['processed_chunks'] = set()
+    state['failed_files'] = {}
+    state['loaded_chunks'] = 0
+    state['sampled_chunks'] = []
@@ -0,0 +1,149 @@
+import streamlit as st
+
+import threading
+from time import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.retrieval import retrieve, pack_context, get_retrieval_cache, get_query_embedding_cache
+from utils.timing import span
+from utils.globals import AUTO_ANSWER_MAX_WORKERS, RAG_TOP_K
+
+
+ANSWER_SYSTEM_PROMPT = """You draft answers to CDP climate disclosure questionnaire questions for a company.
+Use only the context below, taken from the company's own documents.
+Answer concisely in the voice of the company. If the context does not contain the answer, reply with an empty answer.
+
+Context:
+{context}"""
+
+
+def make_answer_fn(llm, vector_db=None, k=RAG_TOP_K):
+    """
+    Answer function of a bulk answer job: retrieve supporting chunks and ask the LLM.
+
+    :param llm: LangChain chat model, or any object with invoke(messages) returning a message
+        Example: FakeListChatModel(responses=["We report in English."])
+    :param vector_db: Session vector store, None to answer without context
+    :param k: Number of chunks retrieved per question
+    """
+    from langchain.schema import HumanMessage, SystemMessage
+
+    # resolved on the script thread, answer_fn runs in the worker threads of the job
+    cache = get_retrieval_cache()
+    embedding_cache = get_query_embedding_cache()
+
+    def answer_fn(question_id, question):
+        docs = retrieve(vector_db, question, k=k, cache=cache, embedding_cache=embedding_cache) if vector_db is not None else []
+        messages = [
+            SystemMessage(content=ANSWER_SYSTEM_PROMPT.format(context=pack_context(docs))),
+            HumanMessage(content=f"Question {question_id}: {question}"),
+        ]
+        with span('llm.answer', question=question_id):
+            return llm.invoke(messages).content.strip()
+    return answer_fn
+
+
+class AnswerJob:
+    """
+    Background job drafting answers for many questions with a bounded pool of LLM workers.
+
+    Questions are submitted lazily so at most max_workers calls are in flight and
+    cancel() stops new calls right away. Answers are collected as they complete,
+    and the page takes them with drain_results() to write them back incrementally.
+    """
+    def __init__(self, questions, answer_fn, max_workers=AUTO_ANSWER_MAX_WORKERS, on_done=None):
+        """
+        :param questions: List of (question_id, question)
+        :param answer_fn: Called with (question_id, question), returns the answer
+        :param max_workers: Maximum number of concurrent LLM calls
+        :param on_done: Called by the job thread once the last call returned, e.g. to release resources
+        """
+        self.questions = list(questions)
+        self.answer_fn = answer_fn
+        self.max_workers = max(1, max_workers)
+        self.on_done = on_done
+        self.completed = 0
+        self.errors = {}
+        self.started_at = None
+        self.finished_at = None
+        self._results = {}
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def total(self):
+        return len(self.questions)
+
+    @property
+    def status(self):
+        if self._thread is None:
+            return 'pending'
+        if self._thread.is_alive():
+            return 'cancelling' if self._cancel.is_set() else 'running'
+        return 'cancelled' if self._cancel.is_set() else 'done'
+
+    def start(self):
+        self.started_at = time()
+        self._thread = threading.Thread(target=self._run, name='answer-job', daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def has_results(self):
+        with self._lock:
+            return bool(self._results)
+
+    def drain_results(self):
+        """
+        Take the answers completed since the last call, as {question_id: answer}.
+        """
+        with self._lock:
+            results, self._results = self._results, {}
+        return results
+
+    def _run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                in_flight = set()
+                for question_id, question in self.questions:
+                    if self._cancel.is_set():
+                        break
+                    if len(in_flight) >= self.max_workers:
+                        _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    in_flight.add(pool.submit(self._answer_one, question_id, question))
+                wait(in_flight)
+        finally:
+            self.finished_at = time()
+            if self.on_done is not None:
+                self.on_done()
+
+    def _answer_one(self, question_id, question):
+        if self._cancel.is_set():
+            return
+        try:
+            answer = self.answer_fn(question_id, question)
+        except Exception as e:
+            print(f"Error answering {question_id}: {e}")
+            with self._lock:
+                self.errors[question_id] = str(e)
+            return
+
+        with self._lock:
+            self._results[question_id] = answer
+            self.completed += 1
+
+
+@st.cache_resource(show_spinner=False)
+def get_answer_jobs():
+    """
+    Process wide {session_id: AnswerJob}, so a running job survives reruns of its session.
+    Jobs are dropped by their page once finished and applied, or cancelled.
+    """
+    return {}
@@ -0,0 +1,403 @@
+"""
+Offline benchmarks of filtering, ingestion and retrieval.
+
+Runs without network: uploads are embedded with HashingEmbeddings, a deterministic
+bag of words embedding, and every cache and collection lives in a temporary folder.
+Results are written as JSON, with a flat 'summary' of the headline numbers that
+--compare checks against the results of another commit.
+
+Run from the app folder:
+    python -m utils.benchmark                                  # writes benchmark_results.json
+    python -m utils.benchmark --scales 1 10 --output new.json --compare old.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+import numpy as np
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Uploads ingested by the ingestion benchmark, from assets/docs
+BENCHMARK_DOCS = [
+    ('tm-tcfd-2023.txt', 'text/plain'),
+    ('TM 2023 TCFD Report (Final version).docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+]
+
+SEED = 42
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+class HashingEmbeddings:
+    """
+    Deterministic embedding model for offline runs: token counts hashed into dim
+    signed buckets, L2 normalized. Texts sharing words get similar vectors.
+    """
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.model = f"hashing-{dim}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def timings(fn, repeat):
+    """
+    Milliseconds of repeat calls of fn.
+    """
+    result = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        result.append(1000 * (time.perf_counter() - started_at))
+    return result
+
+
+def describe(ms):
+    ms = sorted(ms)
+    return {
+        'median_ms': round(median(ms), 3),
+        'p95_ms': round(ms[min(len(ms) - 1, int(0.95 * len(ms)))], 3),
+        'min_ms': round(ms[0], 3),
+    }
+
+
+
+#---
+# Filtering
+#---
+
+
+def synthetic_catalog(catalog, scale):
+    """
+    Catalog with the questions of catalog repeated scale times, under unique question numbers.
+    """
+    from utils.catalog import QuestionCatalog
+    import pandas as pd
+
+    if scale == 1:
+        return catalog
+    copies = []
+    for i in range(scale):
+        copy = catalog.df.copy()
+        copy['question_number'] = copy['question_number'].astype(str) + f"#{i}"
+        copies.append(copy)
+    return QuestionCatalog(pd.concat(copies, ignore_index=True), catalog.sector_df, normalized=True)
+
+
+def filter_settings(catalog):
+    """
+    Representative filter settings: every question, each single sector, and a narrow selection.
+    """
+    everything = {
+        'supply_chain': catalog.get_options('supply_chain_only'),
+        'ifrs_s2': catalog.get_options('ifrs_s2'),
+        'afi': catalog.get_options('afi'),
+        'module_name': catalog.get_options('module_name'),
+    }
+    settings = [{'sectors': list(catalog.sector_options), **everything}]
+    settings += [{'sectors': [sector], **everything} for sector in catalog.sector_options]
+    settings.append({**everything, 'sectors': list(catalog.sector_options[:2]), 'module_name': everything['module_name'][:2]})
+    return settings
+
+
+def bench_filtering(scales, repeat):
+    from utils.catalog import get_catalog
+    from utils.filtering import FilterCache, filter_positions
+    from utils.text import infer_sector_rows
+    from apps.question_get import apply_filters
+
+    base = get_catalog()
+    results = []
+    for scale in scales:
+        started_at = time.perf_counter()
+        catalog = synthetic_catalog(base, scale)
+        build_ms = 1000 * (time.perf_counter() - started_at)
+        settings = filter_settings(catalog)
+
+        # cold: positions computed without the filter cache, warm: through apply_filters and its cache
+        cold = [t for s in settings for t in timings(lambda: filter_positions(catalog, s, cache=FilterCache()), repeat)]
+        warm = [t for s in settings for t in timings(lambda: apply_filters(catalog, s), repeat)]
+        codes = [catalog.sector_codes([sector]) for sector in catalog.sector_options]
+        sector_rows = [t for c in codes for t in timings(lambda: infer_sector_rows(catalog.df, c, catalog.sector_index), repeat)]
+
+        results.append({
+            'scale': scale,
+            'questions': len(catalog.df),
+            'settings': len(settings),
+            'build_catalog_ms': round(build_ms, 3),
+            'filter_positions_cold': describe(cold),
+            'apply_filters_warm': describe(warm),
+            'infer_sector_rows': describe(sector_rows),
+        })
+        print(f"filtering x{scale}: {len(catalog.df)} questions, "
+              f"cold {results[-1]['filter_positions_cold']['median_ms']} ms, "
+              f"apply_filters {results[-1]['apply_filters_warm']['median_ms']} ms")
+    return results
+
+
+
+#---
+# Ingestion
+#---
+
+
+def ingest(files, embedding, session_id, cache):
+    """
+    Ingest files through an IngestJob, as load_doc_to_db does.
+    Returns (vector_db, seconds, per file status).
+    """
+    from utils.ingest_cache import file_digest
+    from utils.ingest_jobs import IngestJob
+    from utils.vector_store import get_collection_manager
+
+    vector_db = get_collection_manager().open(session_id, embedding)
+    job = IngestJob(session_id, vector_db, embedding, set(), cache=cache)
+    started_at = time.perf_counter()
+    for name, file_type, data in files:
+        job.submit(name, file_type, data, file_digest(data))
+    while job.is_active():
+        time.sleep(0.05)
+    seconds = time.perf_counter() - started_at
+    return vector_db, seconds, job.status()
+
+
+def bench_ingestion(embedding):
+    from utils.ingest_cache import IngestCache
+    from utils.timing import REGISTRY
+
+    files = []
+    for name, file_type in BENCHMARK_DOCS:
+        with open(os.path.join(APP_DIR, 'assets', 'docs', name), 'rb') as f:
+            files.append((name, file_type, f.read()))
+
+    cache = IngestCache('ingest_cache')
+    before = REGISTRY.stats()
+    vector_db, cold_seconds, status = ingest(files, embedding, 'benchmark-cold', cache)
+    after = REGISTRY.stats()
+    _, warm_seconds, _ = ingest(files, embedding, 'benchmark-warm', cache)
+
+    stages = {}
+    for name in ['ingest.parse', 'ingest.chunk', 'ingest.embed', 'vector_store.write']:
+        total = after.get(name, {}).get('total_s', 0) - before.get(name, {}).get('total_s', 0)
+        stages[name] = round(1000 * total, 3)
+
+    result = {
+        'files': [{'name': s['name'], 'status': s['status'], 'chunks': s['chunks'], 'bytes': len(data)} for s, (_, _, data) in zip(status, files)],
+        'chunks': vector_db._collection.count(),
+        'cold_ms': round(1000 * cold_seconds, 3),
+        'cached_ms': round(1000 * warm_seconds, 3),
+        'stages_ms': stages,
+    }
+    print(f"ingestion: {result['chunks']} chunks, cold {result['cold_ms']} ms, cached {result['cached_ms']} ms")
+    return vector_db, result
+
+
+
+#---
+# Retrieval
+#---
+
+
+def synthetic_corpus(texts, size, rng):
+    """
+    size distinct texts made from shuffled words of texts and words drawn from their vocabulary.
+    """
+    words = [text.split() for text in texts if text.strip()]
+    vocabulary = sorted({word for text in words for word in text})
+    corpus = []
+    for i in range(size):
+        text = list(words[i % len(words)])
+        rng.shuffle(text)
+        corpus.append(' '.join(text + list(rng.choice(vocabulary, size=8))))
+    return corpus
+
+
+def bench_retrieval(collection, embedding, name, queries, k, rng):
+    """
+    Query latency of a Chroma collection, and recall@k of its approximate (HNSW) search
+    against an exact search over the same embeddings. Each query is a 12 word window of
+    a stored document, which should come back in the top k ('hit_rate').
+    """
+    stored = collection.get(include=['embeddings', 'documents'])
+    ids = stored['ids']
+    vectors = np.asarray(stored['embeddings'], dtype=np.float32)
+    sources = rng.choice(len(ids), size=min(queries, len(ids)), replace=False)
+    k = min(k, len(ids))
+
+    latencies, recalls, hits = [], [], []
+    for source in sources:
+        words = stored['documents'][source].split()
+        start = int(rng.integers(0, max(1, len(words) - 12)))
+        query = embedding.embed_query(' '.join(words[start:start + 12]))
+
+        started_at = time.perf_counter()
+        found = collection.query(query_embeddings=[query], n_results=k, include=[])['ids'][0]
+        latencies.append(1000 * (time.perf_counter() - started_at))
+
+        # Chroma ranks by L2 distance, the same order as cosine for normalized vectors
+        distances = ((vectors - np.asarray(query, dtype=np.float32)) ** 2).sum(axis=1)
+        exact = {ids[i] for i in np.argsort(distances, kind='stable')[:k]}
+        recalls.append(len(exact.intersection(found)) / k)
+        hits.append(ids[source] in found)
+
+    result = {
+        'corpus': name,
+        'documents': len(ids),
+        'queries': len(sources),
+        'k': k,
+        'query': describe(latencies),
+        'recall_at_k': round(float(np.mean(recalls)), 4),
+        'hit_rate': round(float(np.mean(hits)), 4),
+    }
+    print(f"retrieval {name}: {len(ids)} documents, query {result['query']['median_ms']} ms, "
+          f"recall@{k} {result['recall_at_k']}, hit rate {result['hit_rate']}")
+    return result
+
+
+def index_corpus(texts, embedding, session_id):
+    from langchain.schema import Document
+    from utils.vector_store import get_collection_manager, index_chunks
+
+    vector_db = get_collection_manager().open(session_id, embedding)
+    docs = [Document(page_content=text, metadata={'row': i}) for i, text in enumerate(texts)]
+    index_chunks(vector_db, session_id, docs, embedding.embed_documents(texts), set())
+    return vector_db
+
+
+
+#---
+# Results
+#---
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(results):
+    """
+    Flat {metric: value} of the headline numbers, lower is better except recall and hit rate.
+    """
+    summary = {}
+    for r in results.get('filtering', []):
+        summary[f"filtering.x{r['scale']}.filter_positions_cold_ms"] = r['filter_positions_cold']['median_ms']
+        summary[f"filtering.x{r['scale']}.apply_filters_ms"] = r['apply_filters_warm']['median_ms']
+        summary[f"filtering.x{r['scale']}.infer_sector_rows_ms"] = r['infer_sector_rows']['median_ms']
+    if results.get('ingestion'):
+        summary['ingestion.cold_ms'] = results['ingestion']['cold_ms']
+        summary['ingestion.cached_ms'] = results['ingestion']['cached_ms']
+    for r in results.get('retrieval', []):
+        summary[f"retrieval.{r['corpus']}.query_ms"] = r['query']['median_ms']
+        summary[f"retrieval.{r['corpus']}.recall_at_k"] = r['recall_at_k']
+        summary[f"retrieval.{r['corpus']}.hit_rate"] = r['hit_rate']
+    return summary
+
+
+def compare(old, new):
+    """
+    Print the summary metrics of two result files side by side.
+    """
+    print(f"{'metric':<55} {'old':>10} {'new':>10} {'ratio':>7}")
+    for metric, value in new['summary'].items():
+        previous = old.get('summary', {}).get(metric)
+        ratio = f"{value / previous:.2f}" if previous else '-'
+        print(f"{metric:<55} {previous if previous is not None else '-':>10} {value:>10} {ratio:>7}")
+
+
+def run(scales, repeat, queries, k, corpus_scale, skip_ingestion=False):
+    rng = np.random.default_rng(SEED)
+    embedding = HashingEmbeddings()
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scales': scales,
+            'repeat': repeat,
+            'seed': SEED,
+        },
+        'filtering': bench_filtering(scales, repeat),
+        'retrieval': [],
+    }
+
+    if not skip_ingestion:
+        vector_db, results['ingestion'] = bench_ingestion(embedding)
+        results['retrieval'].append(bench_retrieval(vector_db._collection, embedding, 'documents', queries, k, rng))
+
+    from utils.catalog import get_catalog
+    questions = get_catalog().df['2024_question'].astype(str).tolist()
+    corpus = synthetic_corpus(questions, len(questions) * corpus_scale, rng)
+    vector_db = index_corpus(corpus, embedding, f'benchmark-questions-x{corpus_scale}')
+    results['retrieval'].append(bench_retrieval(vector_db._collection, embedding, f'questions_x{corpus_scale}', queries, k, rng))
+
+    results['summary'] = summarize(results)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='catalog sizes, as multiples of cdpq.csv')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per filter setting')
+    parser.add_argument('--queries', type=int, default=50, help='queries per retrieval corpus')
+    parser.add_argument('--k', type=int, default=4, help='results per query')
+    parser.add_argument('--corpus-scale', type=int, default=10, help='synthetic retrieval corpus size, as multiples of the catalog questions')
+    parser.add_argument('--skip-ingestion', action='store_true', help='skip ingesting the sample documents')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    # caches, collections and parse workers run in a scratch folder, away from the app data
+    workdir = tempfile.mkdtemp(prefix='rpgpt-benchmark-')
+    sys.path.insert(0, APP_DIR)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args.scales, args.repeat, args.queries, args.k, args.corpus_scale, args.skip_ingestion)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if previous is not None:
+        compare(previous, results)
+
+
+if __name__ == '__main__':
+    main()
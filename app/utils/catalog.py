@@ -0,0 +1,191 @@
+import streamlit as st
+import hashlib
+import pandas as pd
+import numpy as np
+
+from utils.text import normalize_string, SectorIndex
+from utils.path_utils import get_file_path
+from utils.catalog_cache import read_cached, write_cached
+from utils.timing import span, timed
+
+
+# Low cardinality columns stored as pandas categoricals
+CATEGORICAL_COLUMNS = [
+    'module_number',
+    'module_name',
+    'section',
+    'integrated',
+    'environmental_issues_covered',
+    'sector',
+    'public_authorities',
+    'supply_chain_only',
+    'climate_change',
+    'forests_change',
+    'water_change',
+    'integration',
+    'alignment_with_ifrs_s2',
+    'alignment_with_other_standard_or_framework',
+    'general_improvement',
+    'ifrs_s2',
+    'tnfd',
+    'esrs',
+    'afi',
+]
+
+# Columns offered as filter options on the Get Questions page
+OPTION_COLUMNS = ['supply_chain_only', 'ifrs_s2', 'afi', 'module_name']
+
+# Workbook the sample CSVs come from, with the header row of each sheet
+WORKBOOK = 'CDP_Question_Level_Changes_and_Map_2024.xlsx'
+WORKBOOK_SHEETS = {
+    'Question Mapping': 1,
+    'Sector codes': 0,
+    'Removed Questions': 0,
+    'Copy Forward': 0,
+}
+
+
+def normalize_catalog(df, sector_df):
+    """
+    Normalized copies of the question and sector code tables:
+    snake case columns, NaN as "NaN" strings and categorical low cardinality columns.
+    """
+    df = df.copy()
+    df.columns = [normalize_string(col) for col in df.columns]
+    df = df.replace({np.nan: 'NaN'})  # Replace NaNs with "NaN" string in the dataframe
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(str).astype('category')
+
+    sector_df = sector_df.copy()
+    sector_df.columns = [normalize_string(col) for col in sector_df.columns]
+    return df, sector_df
+
+
+class QuestionCatalog:
+    """
+    Immutable, process-wide CDP question catalog.
+
+    Holds the normalized question and sector code tables, the precompiled
+    SectorIndex and the filter option lists. One instance is shared by every
+    session through get_catalog(), so treat its frames as read only and filter
+    them into new frames instead of modifying them in place.
+    """
+    def __init__(self, df, sector_df, normalized=False):
+        """
+        :param normalized: Frames are already normalized, e.g. read from the columnar cache
+        """
+        if not normalized:
+            df, sector_df = normalize_catalog(df, sector_df)
+
+        self.df = df
+        self.sector_df = sector_df
+        self.sector_index = SectorIndex(df['sector'])
+        self.options = {col: tuple(str(val) for val in df[col].unique()) for col in OPTION_COLUMNS}
+        self.sector_options = tuple(sector_df['sector'].unique())
+        self._sector_codes = dict(zip(sector_df['sector'], sector_df['sector_code']))
+        self.fingerprint = hashlib.sha256(
+            pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+        ).hexdigest()[:16]
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            raise AttributeError(f"QuestionCatalog is immutable, cannot reassign '{name}'")
+        super().__setattr__(name, value)
+
+    def get_options(self, column):
+        """
+        Unique values of a filter column as a new list of strings.
+        Example:
+
+        >>> catalog = QuestionCatalog.from_csv()
+        >>> catalog.get_options('afi')
+        ['No', 'Yes']
+        """
+        return list(self.options[column])
+
+    def sector_codes(self, sectors):
+        """
+        Map sector names to sector codes.
+        Example:
+
+        >>> catalog = QuestionCatalog.from_csv()
+        >>> catalog.sector_codes(['Cement', 'Steel'])
+        ['CE', 'ST']
+        """
+        return [self._sector_codes[sector] for sector in sectors if sector in self._sector_codes]
+
+    @classmethod
+    @timed('catalog.read_csv')
+    def from_csv(cls, questions_file='cdpq.csv', sectors_file='cdpq_sector_codes.csv'):
+        df = pd.read_csv(get_file_path(questions_file))
+        sector_df = pd.read_csv(get_file_path(sectors_file), header=0)
+        return cls(df, sector_df)
+
+    @classmethod
+    def load(cls, questions_file='cdpq.csv', sectors_file='cdpq_sector_codes.csv'):
+        """
+        Load the catalog from the columnar cache.
+        Falls back to the CSV files when the cache is missing or stale, and refreshes it.
+        """
+        with span('catalog.load') as attrs:
+            df = read_cached(questions_file)
+            sector_df = read_cached(sectors_file)
+            if df is not None and sector_df is not None:
+                attrs['source'] = 'cache'
+                return cls(df, sector_df, normalized=True)
+
+            attrs['source'] = 'csv'
+            catalog = cls.from_csv(questions_file, sectors_file)
+            write_cached(catalog.df, questions_file)
+            write_cached(catalog.sector_df, sectors_file)
+            return catalog
+
+
+def load_workbook_sheet(sheet):
+    """
+    Sheet of the CDP question mapping workbook with normalized columns and string values,
+    from the columnar cache when fresh. Reading the workbook itself requires openpyxl.
+    Example:
+
+    >>> load_workbook_sheet('Removed Questions').columns.tolist()
+    ['removed_question_number_2023', 'questionnaire_2023', 'question']
+    """
+    df = read_cached(WORKBOOK, sheet)
+    if df is None:
+        df = pd.read_excel(get_file_path(WORKBOOK), sheet_name=sheet, header=WORKBOOK_SHEETS[sheet], dtype=str)
+        df = df.dropna(how='all')
+        df.columns = [normalize_string(str(col)) for col in df.columns]
+        write_cached(df, WORKBOOK, sheet)
+    return df
+
+
+@st.cache_resource(show_spinner=False)
+def get_catalog():
+    """
+    Load the question catalog once per server process and share it across sessions.
+    """
+    return QuestionCatalog.load()
+
+
+def build_cache():
+    """
+    Build the columnar cache of all sample catalogs, run from the app folder:
+        python -m utils.catalog
+    """
+    catalog = QuestionCatalog.from_csv()
+    write_cached(catalog.df, 'cdpq.csv')
+    write_cached(catalog.sector_df, 'cdpq_sector_codes.csv')
+    print(f"Cached cdpq.csv ({len(catalog.df)} questions) and cdpq_sector_codes.csv")
+
+    for sheet in WORKBOOK_SHEETS:
+        try:
+            df = load_workbook_sheet(sheet)
+        except ImportError as e:
+            print(f"Skipped {WORKBOOK}: {e}")
+            break
+        print(f"Cached {WORKBOOK} [{sheet}] ({len(df)} rows)")
+
+
+if __name__ == '__main__':
+    build_cache()
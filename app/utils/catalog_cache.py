@@ -0,0 +1,98 @@
+"""
+Columnar cache of the sample catalogs.
+
+Catalog CSV and Excel sheets are stored once normalized as uncompressed Feather
+(Arrow IPC) files, whose columns are read from a memory map instead of parsed from
+text. Converting them to a DataFrame still copies every column, text columns into
+Python strings, which is the bulk of a cached load. Each
+Feather file has a .json sidecar with the size and modification time of its source,
+and is ignored as stale once the source changes.
+"""
+import os
+import json
+import threading
+
+from utils.path_utils import get_file_path
+from utils.globals import CATALOG_CACHE_DIR
+
+
+# Bumped when the normalization of cached frames changes
+CACHE_FORMAT = 1
+
+
+def _slug(name):
+    return ''.join(ch if ch.isalnum() or ch in '-_.' else '_' for ch in name)
+
+
+def cache_path(source, sheet=None, cache_dir=CATALOG_CACHE_DIR):
+    """
+    Feather file caching a sample file, or one sheet of a workbook.
+    Example:
+        cache_path("cdpq.csv")
+        "catalog_cache/cdpq.csv.feather"
+    """
+    name = _slug(source) if sheet is None else f"{_slug(source)}-{_slug(sheet)}"
+    return os.path.join(cache_dir, f"{name}.feather")
+
+
+def source_signature(source, sheet=None):
+    stat = os.stat(get_file_path(source))
+    return {
+        'format': CACHE_FORMAT,
+        'source': source,
+        'sheet': sheet,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def read_cached(source, sheet=None, cache_dir=CATALOG_CACHE_DIR):
+    """
+    Cached frame of a sample file, read from a memory map and copied into pandas,
+    or None when missing or stale.
+    """
+    path = cache_path(source, sheet, cache_dir)
+    try:
+        with open(path + '.json', 'r', encoding='utf-8') as f:
+            if json.load(f) != source_signature(source, sheet):
+                return None
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).to_pandas()
+    except (OSError, ValueError, KeyError, ImportError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Catalog cache unavailable for {source}: {e}")
+        return None
+
+
+def write_cached(df, source, sheet=None, cache_dir=CATALOG_CACHE_DIR):
+    """
+    Cache a normalized frame of a sample file. Failures only skip the cache.
+
+    Both files are written under temporary names first. The old sidecar is removed before
+    the data file is replaced and the new sidecar is published last, so readers see either
+    a complete entry or a miss.
+    """
+    path = cache_path(source, sheet, cache_dir)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # script threads of one process rebuild concurrently
+    try:
+        import pyarrow.feather as feather
+
+        os.makedirs(cache_dir, exist_ok=True)
+        feather.write_feather(df.reset_index(drop=True), tmp_path, compression='uncompressed')
+        with open(tmp_path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(source_signature(source, sheet), f)
+        try:
+            os.remove(path + '.json')
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        os.replace(tmp_path + '.json', path + '.json')
+        return True
+    except (OSError, ValueError, TypeError, ImportError) as e:
+        print(f"Unable to cache {source}: {e}")
+        for leftover in [tmp_path, tmp_path + '.json']:
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+        return False
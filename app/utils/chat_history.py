@@ -0,0 +1,106 @@
+from utils.tokens import count_tokens
+from utils.globals import CHAT_HISTORY_TOKENS, CHAT_SUMMARY_WORDS
+
+
+SUMMARY_PROMPT = """Summarize the conversation below for the assistant that continues it, in at most {max_words} words.
+Keep facts, figures, decisions and open questions.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}"""
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators added by the chat format
+
+
+def message_tokens(msg):
+    """
+    Token count of a chat history message, computed once and cached in the message.
+    :param msg: {'role': 'user' | 'assistant', 'content': str}
+    """
+    if 'tokens' not in msg:
+        msg['tokens'] = count_tokens(msg['content']) + MESSAGE_OVERHEAD_TOKENS
+    return msg['tokens']
+
+
+def empty_summary():
+    """
+    Running summary of the messages before history[upto].
+    """
+    return {'upto': 0, 'content': '', 'tokens': 0}
+
+
+def recent_window(history, token_budget, start=0):
+    """
+    Index of the oldest message of the most recent messages of history[start:] fitting in a token budget.
+    The window starts on a user message and always keeps the latest message.
+    """
+    index = len(history)
+    used_tokens = 0
+    while index > start and used_tokens + message_tokens(history[index - 1]) <= token_budget:
+        index -= 1
+        used_tokens += message_tokens(history[index])
+
+    if index == len(history) and index > start:
+        index -= 1
+    while index < len(history) - 1 and history[index]['role'] != 'user':
+        index += 1
+    return index
+
+
+def pack_history(history, token_budget=CHAT_HISTORY_TOKENS, summary=None):
+    """
+    Most recent messages fitting in a token budget, after the running summary if any.
+    Example:
+
+    >>> history = [
+    ...     {'role': 'user', 'content': 'Hi'},
+    ...     {'role': 'assistant', 'content': 'Hello! How can I help?'},
+    ...     {'role': 'user', 'content': 'Summarize the report'},
+    ... ]
+    >>> [msg['content'] for msg in pack_history(history, token_budget=2000)]
+    ['Hi', 'Hello! How can I help?', 'Summarize the report']
+    >>> [msg['content'] for msg in pack_history(history, token_budget=20)]  # the window starts on a user message
+    ['Summarize the report']
+    """
+    start = 0
+    if summary and summary['content']:
+        start = summary['upto']
+        token_budget -= summary['tokens']
+    return history[recent_window(history, max(token_budget, 0), start):]
+
+
+def fold_history(history, summary, summarize_fn, token_budget=CHAT_HISTORY_TOKENS):
+    """
+    Fold the oldest messages into the running summary once the unsummarized messages overflow the budget.
+    Messages are folded until the rest fits in half the budget, so the summary is only
+    updated every few turns rather than on every message.
+
+    :param summary: Running summary, see empty_summary()
+    :param summarize_fn: Called with (summary text, messages to fold), returns the new summary text
+
+    Returns the updated summary
+    """
+    unsummarized = history[summary['upto']:]
+    if sum(message_tokens(msg) for msg in unsummarized) + summary['tokens'] <= token_budget:
+        return summary
+
+    upto = recent_window(history, token_budget // 2, start=summary['upto'])
+    if upto <= summary['upto']:
+        return summary
+    content = summarize_fn(summary['content'], history[summary['upto']:upto])
+    return {'upto': upto, 'content': content, 'tokens': count_tokens(content)}
+
+
+def make_summarize_fn(llm, max_words=CHAT_SUMMARY_WORDS):
+    """
+    Summarize function of fold_history() asking the chat model for the new summary.
+    """
+    from langchain.schema import HumanMessage
+
+    def summarize_fn(summary, messages):
+        text = "\n\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+        prompt = SUMMARY_PROMPT.format(max_words=max_words, summary=summary or 'None', messages=text)
+        return llm.invoke([HumanMessage(content=prompt)]).content.strip()
+    return summarize_fn
@@ -0,0 +1,120 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from utils.globals import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MAX_WORKERS,
+    EMBEDDING_MAX_RETRIES,
+)
+
+
+def is_rate_limited(error):
+    """
+    Whether an embedding request failed with HTTP 429.
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429
+
+
+def retry_after_seconds(error):
+    """
+    Seconds to wait from the Retry-After header of a rate limited response, if any.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitGate:
+    """
+    Shared pause for all embedding workers.
+    When one request is rate limited, every worker waits before sending the next one.
+    """
+    def __init__(self):
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+
+def embed_batch(embedding, texts, gate, max_retries=EMBEDDING_MAX_RETRIES):
+    """
+    Embed one batch of texts, backing off exponentially on rate limits.
+    """
+    for attempt in range(max_retries + 1):
+        gate.wait()
+        try:
+            return embedding.embed_documents(texts)
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == max_retries:
+                raise
+            delay = retry_after_seconds(e) or min(60, 2 ** attempt) * (1 + random.random())
+            print(f"Embedding rate limited, retrying in {delay:.1f}s")
+            gate.pause(delay)
+
+
+def embed_in_batches(
+    texts,
+    embedding,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_workers=EMBEDDING_MAX_WORKERS,
+    max_retries=EMBEDDING_MAX_RETRIES,
+    on_progress=None,
+):
+    """
+    Embed texts in batches with a bounded number of requests in flight.
+
+    :param texts: Texts to embed
+    :param embedding: LangChain Embeddings
+        Example: OpenAIEmbeddings(api_key=..., base_url="http://localhost:8000/v1")
+    :param batch_size: Number of texts per request
+    :param max_workers: Maximum number of concurrent requests
+    :param on_progress: Called with (embedded, total) after each batch
+        Example: lambda done, total: progress_bar.progress(done / total)
+
+    Returns float32 array of shape (len(texts), dim), in the order of texts.
+    """
+    if len(texts) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = [None] * len(batches)
+    gate = RateLimitGate()
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {
+            pool.submit(embed_batch, embedding, batch, gate, max_retries): batch_idx
+            for batch_idx, batch in enumerate(batches)
+        }
+        try:
+            for future in as_completed(futures):
+                batch_idx = futures[future]
+                results[batch_idx] = future.result()
+                done += len(batches[batch_idx])
+                if on_progress is not None:
+                    on_progress(done, len(texts))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return np.asarray([vector for batch in results for vector in batch], dtype=np.float32)
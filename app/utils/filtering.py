@@ -0,0 +1,141 @@
+import streamlit as st
+import numpy as np
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils.globals import FILTER_CACHE_MAX_BYTES
+from utils.timing import timed
+
+
+# Settings keys and the catalog columns they filter
+FILTER_COLUMNS = {
+    'supply_chain': 'supply_chain_only',
+    'ifrs_s2': 'ifrs_s2',
+    'afi': 'afi',
+    'module_name': 'module_name',
+}
+
+
+def settings_key(catalog, settings):
+    """
+    Canonical hash of filter settings for a catalog.
+    Order and duplicates of the selected values do not change the key.
+    Example:
+
+    >>> from types import SimpleNamespace
+    >>> catalog = SimpleNamespace(fingerprint='3f2a9c1d0b7e4a65')  # only the fingerprint is read
+    >>> key = settings_key(catalog, {'sectors': ['Cement'], 'afi': ['Yes', 'No', 'Yes']})
+    >>> key == settings_key(catalog, {'afi': ['No', 'Yes'], 'sectors': ['Cement']})
+    True
+    """
+    canonical = {
+        key: sorted({str(val) for val in values})
+        for key, values in settings.items()
+    }
+    payload = json.dumps([catalog.fingerprint, canonical], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FilterCache:
+    """
+    Thread safe LRU cache of filter results, shared by all sessions.
+
+    Values are read only arrays of catalog row positions rather than
+    DataFrame copies, and the cache is bounded by the total bytes of those arrays.
+    """
+    def __init__(self, max_bytes=FILTER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            positions = self._entries.get(key)
+            if positions is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return positions
+
+    def put(self, key, positions):
+        positions = np.asarray(positions)
+        positions.setflags(write=False)
+        if positions.nbytes > self.max_bytes:
+            return positions
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = positions
+            self.current_bytes += positions.nbytes
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+        return positions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Example:
+
+        >>> get_filter_cache().stats()  # doctest: +SKIP
+        {'entries': 3, 'bytes': 5472, 'max_bytes': 16777216, 'hits': 12, 'misses': 3}
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_filter_cache():
+    """
+    Process wide filter result cache.
+    """
+    return FilterCache()
+
+
+@timed('filter.filter_positions')
+def filter_positions(catalog, settings, cache=None):
+    """
+    Row positions of the catalog questions matching the settings, memoized by settings_key.
+
+    :param catalog: QuestionCatalog
+    :param settings: Settings with every filter resolved to its list of selected values
+        Example: {'sectors': ['Cement'], 'supply_chain': ['No'], 'ifrs_s2': ['Yes', 'No'], 'afi': ['No'], 'module_name': ['Governance']}
+    :param cache: FilterCache, defaults to the process wide cache
+    """
+    cache = get_filter_cache() if cache is None else cache
+    key = settings_key(catalog, settings)
+
+    positions = cache.get(key)
+    if positions is not None:
+        return positions
+
+    df = catalog.df
+    mask = np.ones(len(df), dtype=bool)
+    for settings_name, column in FILTER_COLUMNS.items():
+        mask &= df[column].isin(settings.get(settings_name, [])).to_numpy()
+
+    sectors = settings.get('sectors', [])
+    if sectors:
+        mask &= catalog.sector_index.mask(catalog.sector_codes(sectors))
+
+    positions = np.flatnonzero(mask).astype(np.int32)
+    return cache.put(key, positions)
@@ -1,3 +1,5 @@
+import os
+
 AI_MODELS = {
   "openai": [
     "openai/gpt-4o-mini",
@@ -9,4 +11,74 @@ AI_MODELS = {
   ]
 }
 
-MAX_TOTAL_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
\ No newline at end of file
+MAX_TOTAL_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
+
+FILTER_CACHE_MAX_BYTES = 16 * 1024 * 1024  # 16 MB of cached row positions, shared by all sessions
+
+INGEST_CACHE_DIR = 'ingest_cache'  # content addressed cache of parsed, chunked and embedded uploads
+INGEST_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB of cached uploads on disk, least recently used files are pruned beyond it
+
+# Embedding pipeline for uploads
+EMBEDDING_BATCH_SIZE = 64  # chunks per embedding request
+EMBEDDING_MAX_WORKERS = 4  # embedding requests in flight
+EMBEDDING_MAX_RETRIES = 6  # retries of a rate limited (HTTP 429) request
+EMBEDDING_BASE_URL = os.environ.get('OPENAI_EMBEDDING_BASE_URL')  # e.g. a local fake embeddings server
+INGEST_WINDOW_SIZE = 256  # chunks held in memory per upload while streaming through embedding
+
+# Vector store
+CHROMA_DIR = 'chroma_db'
+VECTOR_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB estimated across all session collections
+ACTIVE_SESSION_TTL = 30 * 60  # seconds since last access before a session collection can be evicted
+
+# Retrieval augmented chat
+RAG_TOP_K = 4  # chunks retrieved per question
+RAG_FETCH_K = 20  # candidates considered by MMR
+RAG_MAX_DISTANCE = None  # drop similarity results farther than this distance, None keeps all
+RAG_CONTEXT_TOKENS = 6000  # token budget of the retrieved context in the prompt
+RETRIEVAL_CACHE_SIZE = 1024  # entries of the query embedding and retrieval result caches
+
+AUTO_ANSWER_MAX_WORKERS = 4  # default concurrent LLM calls when drafting answers in bulk
+
+# Chat model clients, shared by all sessions
+LLM_CLIENT_IDLE_TTL = 15 * 60  # seconds unused before a pooled chat model and its connections are closed
+LLM_CLIENT_MAX_CONNECTIONS = 20  # keep-alive connections per pooled OpenAI client
+LLM_CLIENT_KEEPALIVE_EXPIRY = 60  # seconds an idle keep-alive connection stays open
+
+# Chat history sent with each AI Chat turn
+CHAT_HISTORY_TOKENS = 4000  # token budget of the recent messages in the prompt
+CHAT_SUMMARY_WORDS = 200  # length of the running summary of older messages
+
+# LLM response cache, shared by all sessions
+RESPONSE_CACHE_SIZE = 512  # cached answers
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds a cached answer stays valid
+RESPONSE_CACHE_SIMILARITY = 0.95  # cosine similarity for a near duplicate question to reuse an answer, None for exact matches only
+
+# Rendering of streamed LLM answers
+STREAM_FRAME_INTERVAL = 0.05  # seconds between frames sent to the page
+STREAM_FRAME_CHARS = 200  # characters that flush a frame early
+
+# Background ingestion of uploads
+INGEST_PARSE_WORKERS = 2  # processes parsing the uploads of each session
+INGEST_PARSE_MAX_PROCESSES = 4  # parse processes across all sessions, jobs beyond it wait for a free one
+INGEST_PARSE_TIMEOUT = 5 * 60  # seconds a file may parse before it fails
+INGEST_PARSE_ATTEMPTS = 2  # parses of a file whose worker crashed, including the first
+
+CATALOG_CACHE_DIR = 'catalog_cache'  # columnar (Feather) copies of the sample catalogs, rebuilt when their source changes
+
+SEARCH_MAX_RESULTS = 50  # questions shown for a full-text search on the Read Question page
+QUESTIONS_PER_PAGE = 25  # rows sent to the answer editor of the Read Question page
+
+QA_AUTOSAVE_DIR = 'autosave'  # journals of the answers of each session, for recovery after a crash
+QA_AUTOSAVE_INTERVAL = 30  # seconds between autosaves of the Read Question page
+QA_AUTOSAVE_RETENTION = 7 * 24 * 3600  # seconds an unused journal is kept
+
+# Session memory
+SESSION_MEMORY_MAX_BYTES = 64 * 1024 * 1024  # 64 MB of session state before keys of closed pages spill to disk
+SESSION_SPILL_DIR = 'session_spill'  # spilled session state, one folder per session
+SESSION_SPILL_RETENTION = 24 * 3600  # seconds the spill folder of an inactive session is kept
+
+# Timing instrumentation
+TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # histogram bounds in seconds
+TIMING_LOG_SIZE = 1000  # recent spans kept in memory for the admin export
+TIMING_LOG_FILE = os.environ.get('RPGPT_TIMING_LOG')  # append spans as JSON lines to this file
+TIMING_PROMETHEUS_FILE = os.environ.get('RPGPT_PROMETHEUS_FILE')  # write Prometheus text metrics to this file after each page run
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from utils.globals import INGEST_CACHE_DIR, INGEST_CACHE_MAX_BYTES
+
+
+def file_digest(data):
+    """
+    Content address of an uploaded file.
+    Example:
+        file_digest(b"Hello, world!")
+        "315f5bdb76d078c43b8ac0064e4a0164612b1fce77c869345bfc94c75894edd3"
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def _model_slug(model_name):
+    return ''.join(ch if ch.isalnum() or ch in '-_.' else '_' for ch in model_name)
+
+
+class ChunkWriter:
+    """
+    Streams parsed documents and chunk boundaries of one file into the cache.
+    Files are written under temporary names and only published by commit().
+    """
+    def __init__(self, entry_dir):
+        os.makedirs(entry_dir, exist_ok=True)
+        self._paths = {
+            name: os.path.join(entry_dir, name)
+            for name in ['docs.jsonl', 'chunks.jsonl']
+        }
+        self._tmp_suffix = f".{os.getpid()}.{id(self)}.tmp"
+        self._files = {
+            name: open(path + self._tmp_suffix, 'w', encoding='utf-8')
+            for name, path in self._paths.items()
+        }
+        self._last_text = ''
+        self._doc_count = 0
+
+    def add_doc(self, doc):
+        """
+        Write a parsed document, returns its index.
+        Only the text of the latest document is kept in memory to locate its chunks.
+        """
+        self._files['docs.jsonl'].write(json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}) + '\n')
+        self._last_text = doc.page_content
+        self._doc_count += 1
+        return self._doc_count - 1
+
+    def add_chunk(self, chunk):
+        """
+        Write the boundary of a chunk of the latest document.
+        Chunks must come from a splitter with add_start_index=True.
+        """
+        start = chunk.metadata.get('start_index', -1)
+        boundary = {'doc': self._doc_count - 1, 'metadata': chunk.metadata}
+        text = self._last_text
+        if start >= 0 and text[start:start + len(chunk.page_content)] == chunk.page_content:
+            boundary.update(start=start, end=start + len(chunk.page_content))
+        else:
+            boundary['text'] = chunk.page_content
+        self._files['chunks.jsonl'].write(json.dumps(boundary) + '\n')
+
+    def commit(self):
+        for name, f in self._files.items():
+            f.close()
+            os.replace(self._paths[name] + self._tmp_suffix, self._paths[name])
+
+    def discard(self):
+        for name, f in self._files.items():
+            f.close()
+            try:
+                os.remove(self._paths[name] + self._tmp_suffix)
+            except OSError:
+                pass
+
+
+class EmbeddingWriter:
+    """
+    Streams chunk embeddings of one file and model into the cache as raw float32 rows.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._tmp_path = f"{path}.{os.getpid()}.{id(self)}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+        self._count = 0
+        self._dim = None
+
+    def add(self, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(embeddings) == 0:
+            return
+        self._dim = embeddings.shape[1]
+        self._file.write(embeddings.tobytes())
+        self._count += len(embeddings)
+
+    def commit(self):
+        self._file.close()
+        with open(self._tmp_path + '.json', 'w', encoding='utf-8') as f:
+            json.dump({'count': self._count, 'dim': self._dim}, f)
+        os.replace(self._tmp_path, self._path)
+        os.replace(self._tmp_path + '.json', self._path + '.json')
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class IngestCache:
+    """
+    Persistent, content addressed cache of document ingestion.
+
+    Entries are keyed by the SHA-256 of the uploaded file bytes and hold the
+    parsed documents, the chunk boundaries within those documents and the chunk
+    embeddings of each embedding model. Everything is written and read as a
+    stream, one document or chunk at a time. Layout:
+
+        <root>/<digest[:2]>/<digest>/docs.jsonl
+        <root>/<digest[:2]>/<digest>/chunks.jsonl
+        <root>/<digest[:2]>/<digest>/embeddings-<model>.f32 (+ .json with count and dim)
+
+    The modification time of an entry folder is its last use, and prune() removes the
+    least recently used entries once the cache holds more than max_bytes.
+    """
+    def __init__(self, root=INGEST_CACHE_DIR, max_bytes=INGEST_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _entry_dir(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _touch(self, digest):
+        try:
+            os.utime(self._entry_dir(digest))
+        except OSError:
+            pass  # pruned meanwhile
+
+    def _embeddings_path(self, digest, model_name):
+        return os.path.join(self._entry_dir(digest), f"embeddings-{_model_slug(model_name)}.f32")
+
+    def has_chunks(self, digest):
+        return os.path.exists(os.path.join(self._entry_dir(digest), 'chunks.jsonl'))
+
+    def iter_chunks(self, digest, source=None):
+        """
+        Stream the chunks of a cached file as Documents.
+
+        :param digest: file_digest of the file
+        :param source: Overrides the 'source' metadata, e.g. the current file name
+        """
+        from langchain.schema import Document
+
+        entry_dir = self._entry_dir(digest)
+        self._touch(digest)
+        with open(os.path.join(entry_dir, 'docs.jsonl'), 'r', encoding='utf-8') as docs_file, \
+                open(os.path.join(entry_dir, 'chunks.jsonl'), 'r', encoding='utf-8') as chunks_file:
+            doc_idx, doc = -1, None
+            for line in chunks_file:
+                boundary = json.loads(line)
+                while doc_idx < boundary['doc']:
+                    doc = json.loads(docs_file.readline())
+                    doc_idx += 1
+
+                if 'text' in boundary:
+                    page_content = boundary['text']
+                else:
+                    page_content = doc['page_content'][boundary['start']:boundary['end']]
+                metadata = {**doc['metadata'], **boundary.get('metadata', {})}
+                if source is not None:
+                    metadata['source'] = source
+                yield Document(page_content=page_content, metadata=metadata)
+
+    def chunk_writer(self, digest):
+        return ChunkWriter(self._entry_dir(digest))
+
+    def load_embeddings(self, digest, model_name):
+        """
+        Memory mapped (count, dim) float32 embeddings of a cached file, or None.
+        """
+        path = self._embeddings_path(digest, model_name)
+        try:
+            with open(path + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self._touch(digest)
+            if not meta['count']:
+                return np.zeros((0, 0), dtype=np.float32)
+            return np.memmap(path, dtype=np.float32, mode='r', shape=(meta['count'], meta['dim']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def embedding_writer(self, digest, model_name):
+        os.makedirs(self._entry_dir(digest), exist_ok=True)
+        return EmbeddingWriter(self._embeddings_path(digest, model_name))
+
+    def _entries(self):
+        """
+        (last use, bytes, digest, busy) of the cached files, busy while one of their writers is open.
+        """
+        entries = []
+        for prefix in os.scandir(self.root) if os.path.isdir(self.root) else []:
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    files = list(os.scandir(entry.path))
+                    size = sum(f.stat().st_size for f in files)
+                    entries.append((entry.stat().st_mtime, size, entry.name, any(f.name.endswith('.tmp') for f in files)))
+                except OSError:
+                    continue  # pruned by another process
+        return entries
+
+    def prune(self, max_bytes=None, protect=()):
+        """
+        Remove the least recently used files until the cache fits in max_bytes.
+        Files being written and protected digests are kept.
+        Example:
+
+        >>> IngestCache().prune()  # doctest: +SKIP
+        {'removed': 3, 'freed_bytes': 41943040, 'bytes': 1035993088}
+
+        :param max_bytes: Budget in bytes, defaults to self.max_bytes
+        :param protect: Digests to keep, e.g. the files of a running job
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        protect = set(protect)
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _, _ in entries)
+        removed, freed = 0, 0
+        for _, size, digest, busy in entries:
+            if total <= max_bytes:
+                break
+            if busy or digest in protect:
+                continue
+            shutil.rmtree(self._entry_dir(digest), ignore_errors=True)
+            total -= size
+            removed += 1
+            freed += size
+        return {'removed': removed, 'freed_bytes': freed, 'bytes': total}
+
+
+if __name__ == '__main__':
+    # python -m utils.ingest_cache [max MB], prunes the cache to INGEST_CACHE_MAX_BYTES or the given size
+    max_bytes = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else None
+    print(IngestCache().prune(max_bytes))
@@ -0,0 +1,396 @@
+import streamlit as st
+
+import os
+import random
+import signal
+import threading
+import multiprocessing
+from time import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, CancelledError, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.embedding import embed_in_batches
+from utils.ingest_cache import IngestCache
+from utils.parsing import parse_to_cache, report_worker_pid, get_document_hash
+from utils.vector_store import get_collection_manager, index_chunks
+from utils.timing import span, record_spans
+from utils.globals import INGEST_WINDOW_SIZE, INGEST_PARSE_WORKERS, INGEST_PARSE_MAX_PROCESSES, INGEST_PARSE_TIMEOUT, INGEST_PARSE_ATTEMPTS
+
+
+ACTIVE_STATUSES = ('queued', 'parsing', 'embedding')
+
+
+class ParsePool:
+    """
+    Pool of worker processes parsing the uploads of one ingestion job, outside of the server process.
+
+    Workers are spawned rather than forked, as the server runs many threads, and report
+    their process id on start. A hung parse is stopped with restart(), which kills the
+    workers: parses of the job in flight then fail with BrokenProcessPool, like when a
+    parser crashes its worker, and are resubmitted to a fresh pool. Workers are started
+    on the first submit and stopped with shutdown() once the job is idle.
+
+    Each worker takes a slot of the process wide parse slots, so concurrent jobs never run
+    more than INGEST_PARSE_MAX_PROCESSES workers. A job waits for one slot, then takes
+    as many more as are free, up to max_workers.
+    """
+    def __init__(self, max_workers=INGEST_PARSE_WORKERS, slots=None):
+        """
+        :param slots: Semaphore of the parse slots shared by the jobs, None for no limit
+        """
+        self.max_workers = max_workers
+        self.slots = slots
+        self.workers = 0  # workers of the current executor, each holding a slot
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pids = None
+
+    def _acquire_slots(self):
+        if self.slots is None:
+            return self.max_workers
+        self.slots.acquire()
+        workers = 1
+        while workers < self.max_workers and self.slots.acquire(blocking=False):
+            workers += 1
+        return workers
+
+    def _release_slots(self, workers):
+        if self.slots is not None:
+            for _ in range(workers):
+                self.slots.release()
+
+    def _new_executor(self):
+        if self.workers == 0:
+            self.workers = self._acquire_slots()
+        context = multiprocessing.get_context('spawn')
+        self._pids = context.SimpleQueue()
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=report_worker_pid,
+            initargs=(self._pids,),
+        )
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._new_executor()
+            try:
+                return self._executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._executor = self._new_executor()
+                return self._executor.submit(fn, *args)
+
+    def _take(self):
+        with self._lock:
+            executor, pids, workers = self._executor, self._pids, self.workers
+            self._executor, self._pids, self.workers = None, None, 0
+        return executor, pids, workers
+
+    def restart(self):
+        executor, pids, workers = self._take()
+        self.restarts += 1
+        if executor is None:
+            return
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except OSError:
+                pass  # already exited
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._release_slots(workers)
+
+    def shutdown(self):
+        executor, _, workers = self._take()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._release_slots(workers)
+
+
+@st.cache_resource(show_spinner=False)
+def get_parse_slots():
+    """
+    Process wide parse worker slots, shared by the ingestion jobs of all sessions.
+    """
+    return threading.BoundedSemaphore(INGEST_PARSE_MAX_PROCESSES)
+
+
+def iter_windows(iterable, size):
+    """
+    Group an iterable into lists of at most size items.
+    """
+    window = []
+    for item in iterable:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+class IngestJob:
+    """
+    Background ingestion of the uploads of one session.
+
+    Files queued with submit() are all parsed and chunked into the ingestion cache in
+    parallel by the parse pool of the job. As each parse completes, the worker thread
+    embeds the file through the thread pool of embed_in_batches and indexes it one window
+    of chunks at a time, so a batch takes about as long as its slowest file.
+    A file failing, crashing its parse worker or parsing for longer than parse_timeout
+    seconds only fails that file.
+    The page reads per file status on each rerun, so ingestion survives reruns and
+    widgets stay responsive while large documents ingest. The job does not touch the
+    session state: the page takes the ingested files and chunk hashes with drain_done().
+    """
+    def __init__(self, session_id, vector_db, embedding, processed_chunks, cache=None, collection_manager=None, parse_timeout=INGEST_PARSE_TIMEOUT):
+        """
+        :param session_id: Session owning the vector db
+        :param vector_db: LangChain Chroma vector store of the session
+        :param embedding: Embedding model, e.g. OpenAIEmbeddings(max_retries=0)
+        :param processed_chunks: Hashes of the chunks already indexed in the session, copied
+        :param cache: IngestCache, defaults to the one in INGEST_CACHE_DIR
+        :param collection_manager: CollectionManager, defaults to the process wide one, resolved here
+            as the job thread has no script context
+        :param parse_timeout: Seconds a file may parse before it fails
+        """
+        self.session_id = session_id
+        self.vector_db = vector_db
+        self.embedding = embedding
+        self.processed_chunks = set(processed_chunks)
+        self.cache = cache if cache is not None else IngestCache()
+        self.collection_manager = collection_manager if collection_manager is not None else get_collection_manager()
+        self.parse_pool = ParsePool(slots=get_parse_slots())
+        self.parse_timeout = parse_timeout
+        self.files = {}
+        self.loaded_chunks = 0
+        self.sampled_chunks = []
+        self._queue = deque()
+        self._done = []
+        self._new_chunks = set()
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+
+    def submit(self, file_name, file_type, data, digest):
+        """
+        Queue a file for ingestion. Files already submitted are ignored.
+        Returns True if the file was queued.
+        """
+        with self._lock:
+            if digest in self.files or self._cancel.is_set():
+                return False
+            self.files[digest] = {
+                'name': file_name,
+                'type': file_type,
+                'status': 'queued',
+                'chunks': 0,
+                'error': None,
+                'submitted_at': time(),
+            }
+            self._queue.append((digest, data))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ingest-job', daemon=True)
+                self._thread.start()
+        return True
+
+    def has(self, digest):
+        with self._lock:
+            return digest in self.files
+
+    def cancel(self):
+        self._cancel.set()
+
+    def is_active(self):
+        with self._lock:
+            return any(entry['status'] in ACTIVE_STATUSES for entry in self.files.values())
+
+    def status(self):
+        """
+        Per file status, in submission order.
+        """
+        with self._lock:
+            return [
+                {'digest': digest, **{key: value for key, value in entry.items() if key != 'data'}}
+                for digest, entry in self.files.items()
+            ]
+
+    def drain_done(self):
+        """
+        Take the digests of the files ingested since the last call, and the hashes of
+        the chunks they indexed, for the session state.
+        """
+        with self._lock:
+            done, self._done = self._done, []
+            new_chunks, self._new_chunks = self._new_chunks, set()
+        return done, new_chunks
+
+    def _run(self):
+        try:
+            self._parse_and_index()
+        except BaseException:
+            self.parse_pool.shutdown()  # free the parse slots for the other sessions
+            with self._lock:
+                self._thread = None
+            raise
+        with self._lock:
+            protect = list(self.files)
+        self.cache.prune(protect=protect)  # keep the cache on disk within INGEST_CACHE_MAX_BYTES
+
+    def _parse_and_index(self):
+        parsing = {}  # future: digest
+        retries = deque()  # digests whose parse worker died, retried one at a time
+        while True:
+            with self._lock:
+                queued, self._queue = list(self._queue), deque()
+                if self._cancel.is_set() or not (queued or parsing or retries):
+                    for future in parsing:
+                        future.cancel()
+                    for digest in [*parsing.values(), *retries, *(digest for digest, _ in queued)]:
+                        self.files[digest]['status'] = 'cancelled'
+                    self.parse_pool.shutdown()
+                    self._thread = None
+                    return
+
+            cached = []
+            for digest, data in queued:
+                entry = self.files[digest]
+                entry['data'] = data
+                if self.cache.has_chunks(digest):
+                    print(f"Ingestion cache hit for {entry['name']}")
+                    cached.append(digest)
+                else:
+                    parsing[self._submit_parse(digest, entry)] = digest
+            for digest in cached:
+                self._embed(digest, self.files[digest])
+
+            if retries and not parsing:
+                # alone in the pool, a file crashing its worker again is the one to blame
+                digest = retries.popleft()
+                parsing[self._submit_parse(digest, self.files[digest])] = digest
+
+            done, _ = wait(parsing, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                digest = parsing.pop(future)
+                entry = self.files[digest]
+                try:
+                    _, spans = future.result()
+                    record_spans(spans)
+                except (BrokenProcessPool, CancelledError):
+                    if entry['attempts'] < INGEST_PARSE_ATTEMPTS:
+                        entry['status'] = 'queued'
+                        retries.append(digest)
+                    else:
+                        self._fail(entry, "Parser crashed")
+                except Exception as e:
+                    self._fail(entry, e)
+                else:
+                    self._embed(digest, entry)
+
+            self._check_timeouts(parsing)
+
+    def _submit_parse(self, digest, entry):
+        entry['status'] = 'parsing'
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        entry['parse_started_at'] = None
+        return self.parse_pool.submit(parse_to_cache, entry['name'], entry['type'], entry['data'], digest, self.cache.root)
+
+    def _check_timeouts(self, parsing):
+        """
+        Fail files parsing for longer than parse_timeout and kill the workers of the job.
+        """
+        now = time()
+        # the pool marks one more call than it has workers as running, count the oldest ones
+        running = [future for future in parsing if future.running()][:self.parse_pool.workers]
+        timed_out = []
+        for future in running:
+            entry = self.files[parsing[future]]
+            if entry['parse_started_at'] is None:
+                entry['parse_started_at'] = now
+            elif now - entry['parse_started_at'] > self.parse_timeout:
+                timed_out.append(future)
+
+        for future in timed_out:
+            self._fail(self.files[parsing.pop(future)], f"Parsing timed out after {self.parse_timeout}s")
+        if timed_out:
+            # parses of other files of the job in flight fail with BrokenProcessPool and are retried
+            self.parse_pool.restart()
+
+    def _fail(self, entry, error):
+        print(f"Error loading {entry['name']}: {error}")
+        entry.pop('data', None)
+        entry['error'] = str(error)
+        entry['status'] = 'error'
+
+    def _embed(self, digest, entry):
+        try:
+            self._ingest(digest, entry)
+        except Exception as e:
+            self._fail(entry, e)
+            return
+        entry.pop('data', None)
+        with self._lock:
+            # status and done change together, so a job seen inactive has all its files drainable
+            entry['status'] = 'cancelled' if self._cancel.is_set() else 'done'
+            if entry['status'] == 'done':
+                self._done.append(digest)
+
+    def _ingest(self, digest, entry):
+        entry['status'] = 'embedding'
+        model_name = self.embedding.model
+        cached_embeddings = self.cache.load_embeddings(digest, model_name)
+        embedding_writer = None
+        file_chunks = 0
+        try:
+            for window in iter_windows(self.cache.iter_chunks(digest, source=entry['name']), INGEST_WINDOW_SIZE):
+                if self._cancel.is_set():
+                    return
+                if cached_embeddings is not None and file_chunks + len(window) > len(cached_embeddings):
+                    # cached embeddings are incomplete, keep what matches and embed the rest
+                    embedding_writer = self.cache.embedding_writer(digest, model_name)
+                    embedding_writer.add(cached_embeddings[:file_chunks])
+                    cached_embeddings = None
+                elif cached_embeddings is None and embedding_writer is None:
+                    embedding_writer = self.cache.embedding_writer(digest, model_name)
+
+                if cached_embeddings is not None:
+                    embeddings = cached_embeddings[file_chunks:file_chunks + len(window)]
+                else:
+                    with span('ingest.embed', file=entry['name'], chunks=len(window)):
+                        embeddings = embed_in_batches([chunk.page_content for chunk in window], self.embedding)
+                    embedding_writer.add(embeddings)
+
+                new_chunks = index_chunks(self.vector_db, self.session_id, window, embeddings, self.processed_chunks, manager=self.collection_manager)
+                self._sample(new_chunks)
+                with self._lock:
+                    self._new_chunks.update(get_document_hash(chunk) for chunk in new_chunks)
+                file_chunks += len(window)
+                entry['chunks'] = file_chunks
+
+            if embedding_writer is not None:
+                embedding_writer.commit()
+                embedding_writer = None
+        finally:
+            if embedding_writer is not None:
+                embedding_writer.discard()
+
+    def _sample(self, chunks):
+        # Keep a uniform random sample of the new chunks for display
+        with self._lock:
+            for chunk in chunks:
+                self.loaded_chunks += 1
+                if len(self.sampled_chunks) < 5:
+                    self.sampled_chunks.append(chunk)
+                elif (slot := random.randrange(self.loaded_chunks)) < 5:
+                    self.sampled_chunks[slot] = chunk
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_jobs():
+    """
+    Process wide {session_id: IngestJob}, so ingestion survives reruns of its session.
+    Jobs are dropped by their page once idle and drained.
+    """
+    return {}
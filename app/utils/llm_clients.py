@@ -0,0 +1,100 @@
+import streamlit as st
+
+import hashlib
+import threading
+from time import time
+
+from utils.globals import (
+    LLM_CLIENT_IDLE_TTL,
+    LLM_CLIENT_MAX_CONNECTIONS,
+    LLM_CLIENT_KEEPALIVE_EXPIRY,
+)
+
+
+def api_key_hash(api_key):
+    """
+    Short hash identifying an API key without keeping the key itself in the registry keys.
+    """
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+def create_chat_llm(provider, model_name, api_key, temperature):
+    """
+    New streaming chat model with a keep-alive HTTP connection pool.
+    """
+    if provider == "openai":
+        import httpx
+        from langchain_openai import ChatOpenAI
+
+        limits = httpx.Limits(
+            max_connections=LLM_CLIENT_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_CLIENT_MAX_CONNECTIONS,
+            keepalive_expiry=LLM_CLIENT_KEEPALIVE_EXPIRY,
+        )
+        return ChatOpenAI(
+            api_key=api_key,
+            model_name=model_name,
+            temperature=temperature,
+            streaming=True,
+            http_client=httpx.Client(limits=limits),
+            http_async_client=httpx.AsyncClient(limits=limits),
+        )
+    elif provider == "anthropic":
+        from langchain_anthropic import ChatAnthropic
+
+        # the Anthropic SDK client keeps its own keep-alive connection pool
+        return ChatAnthropic(
+            api_key=api_key,
+            model=model_name,
+            temperature=temperature,
+            streaming=True,
+        )
+    raise ValueError(f"Unknown model provider: {provider}")
+
+
+class LLMClientPool:
+    """
+    Process wide registry of chat models, keyed by (provider, model, API key hash, temperature).
+
+    Chat models hold thread safe HTTP clients, so one instance is shared by every
+    session using the same key and settings, and its connections are reused across
+    reruns and chat turns. Models unused for idle_ttl seconds are dropped from the pool
+    without closing them, as a running answer job or response stream may still hold
+    one; their connections are closed once the last holder lets go of the model.
+    """
+    def __init__(self, idle_ttl=LLM_CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self.created = 0
+        self.reused = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider, model_name, api_key, temperature):
+        key = (provider, model_name, api_key_hash(api_key), temperature)
+        with self._lock:
+            self._evict_idle()
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = self._clients[key] = {'llm': create_chat_llm(provider, model_name, api_key, temperature)}
+                self.created += 1
+            else:
+                self.reused += 1
+            entry['last_used'] = time()
+            return entry['llm']
+
+    def _evict_idle(self):
+        now = time()
+        for key in [key for key, entry in self._clients.items() if now - entry['last_used'] > self.idle_ttl]:
+            del self._clients[key]
+
+    def stats(self):
+        with self._lock:
+            return {'clients': len(self._clients), 'created': self.created, 'reused': self.reused}
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client_pool():
+    """
+    Process wide chat model pool.
+    """
+    return LLMClientPool()
@@ -0,0 +1,174 @@
+"""
+Parsing and chunking of uploads.
+
+Kept free of Streamlit so process pool workers can parse files without importing the app.
+Uploads are parsed straight from their bytes, without writing them to disk first.
+"""
+import io
+import os
+import csv
+import json
+import hashlib
+
+from utils.ingest_cache import IngestCache
+from utils.timing import IterTimer, collect_spans, record_span
+
+
+def iter_pdf_docs(file_name, data):
+    """
+    One document per page of a PDF, parsed by PDFMiner from memory.
+    """
+    from langchain_community.document_loaders.blob_loaders import Blob
+    from langchain_community.document_loaders.parsers.pdf import PDFMinerParser
+
+    yield from PDFMinerParser(concatenate_pages=False).lazy_parse(Blob.from_data(data, path=file_name))
+
+
+def iter_docx_docs(file_name, data):
+    """
+    Text of a Word document, parsed by docx2txt from memory.
+    """
+    import docx2txt
+    from langchain.schema import Document
+
+    yield Document(page_content=docx2txt.process(io.BytesIO(data)), metadata={'source': file_name})
+
+
+def iter_text_docs(file_name, data):
+    from langchain.schema import Document
+
+    yield Document(page_content=str(data, 'utf-8'), metadata={'source': file_name})
+
+
+def iter_csv_docs(file_name, data):
+    """
+    One document per row of a CSV file, formatted like LangChain's CSVLoader.
+    """
+    from langchain.schema import Document
+
+    reader = csv.DictReader(io.StringIO(str(data, 'utf-8'), newline=''))
+    for i, row in enumerate(reader):
+        content = "\n".join(
+            f"{k.strip() if k is not None else k}: "
+            f"{v.strip() if isinstance(v, str) else ','.join(map(str.strip, v)) if isinstance(v, list) else v}"
+            for k, v in row.items()
+        )
+        yield Document(page_content=content, metadata={'source': file_name, 'row': i})
+
+
+# Helper: File reader mapping
+def get_reader(file_type, file_name):
+    """
+    Reader parsing an upload from its bytes in memory, or None for unsupported file types.
+    Readers are called with (file_name, data) and yield Documents.
+    :param file_type: File type
+        Example: "application/pdf"
+    :param file_name: File name
+        Example: "file.pdf"
+    """
+    if file_type == "application/pdf":
+        return iter_pdf_docs
+    elif file_name.endswith(".docx"):
+        return iter_docx_docs
+    elif file_type in ["text/plain", "text/markdown"]:
+        return iter_text_docs
+    elif file_name.endswith(".csv"):
+        return iter_csv_docs
+    else:
+        return None
+
+
+def get_document_hash(doc):
+    """
+    Generate a hash for a document based on its content and metadata, in a single digest.
+    Example:
+        doc = Document(page_content="Hello, world!", metadata={"source": "file.txt"})
+        get_document_hash(doc)
+        "6f4c0a4ad3e7a8b8e5ac3a5b9ea3a7c1"
+    """
+    digest = hashlib.blake2b(doc.page_content.encode('utf-8'), digest_size=16)
+    digest.update(b'\x00')
+    digest.update(json.dumps(doc.metadata, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def iter_doc_chunks(docs, on_doc=None):
+    """
+    Lazily split parsed documents into chunks, one document at a time.
+    Each chunk keeps the index of its document ('doc') and its offset in it ('start_index').
+
+    docs: Iterable[Document], e.g. loader.lazy_load()
+    on_doc: Called with each document before its chunks are yielded
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=5000,
+        chunk_overlap=1000,
+        add_start_index=True,
+    )
+    for doc_idx, doc in enumerate(docs):
+        if on_doc is not None:
+            on_doc(doc)
+        for chunk in text_splitter.split_documents([doc]):
+            chunk.metadata['doc'] = doc_idx
+            yield chunk
+
+
+def iter_upload_chunks(file_name, file_type, data, digest, cache):
+    """
+    Stream the chunks of an uploaded file, from the ingestion cache when available.
+    Parsed documents and chunk boundaries are written to the cache as they stream,
+    and only published once the whole file went through.
+
+    :param file_name: Name of the uploaded file
+    :param file_type: MIME type of the uploaded file
+    :param data: Bytes of the file
+    :param digest: file_digest of data
+    :param cache: IngestCache
+    """
+    if cache.has_chunks(digest):
+        yield from cache.iter_chunks(digest, source=file_name)
+        return
+
+    reader = get_reader(file_type, file_name)
+    if reader is None:
+        raise ValueError(f"Unsupported file type of {file_type}")
+
+    def on_doc(doc):
+        doc.metadata['source'] = file_name
+        writer.add_doc(doc)
+
+    writer = cache.chunk_writer(digest)
+    docs = IterTimer(reader(file_name, data))
+    chunks = IterTimer(iter_doc_chunks(docs, on_doc=on_doc))
+    try:
+        for chunk in chunks:
+            writer.add_chunk(chunk)
+            yield chunk
+    except BaseException:
+        writer.discard()
+        raise
+    writer.commit()
+    # chunks are split as documents are parsed, the time producing chunks includes parsing
+    record_span('ingest.parse', docs.seconds, file=file_name, docs=docs.items)
+    record_span('ingest.chunk', chunks.seconds - docs.seconds, file=file_name, chunks=chunks.items)
+
+
+def report_worker_pid(pids):
+    """
+    Initializer of parse workers, reporting their process id so a hung worker can be killed.
+    """
+    pids.put(os.getpid())
+
+
+def parse_to_cache(file_name, file_type, data, digest, cache_root):
+    """
+    Parse and chunk an upload into the ingestion cache, run in a process pool worker.
+    Returns the number of chunks and the timing spans of the worker, for record_spans.
+    """
+    chunk_count = 0
+    with collect_spans(propagate=False) as spans:
+        for _ in iter_upload_chunks(file_name, file_type, data, digest, IngestCache(cache_root)):
+            chunk_count += 1
+    return chunk_count, spans
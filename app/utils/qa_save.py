@@ -0,0 +1,218 @@
+"""
+Q&A save files and autosave journals.
+
+Save files are gzipped newline delimited JSON: a header line holding the filter
+settings and the fingerprint of the question catalog, then one line per answered
+question with its question_id and answer. Question text is looked up in the catalog
+on load, so a save only grows with the number of answers.
+
+Autosave journals use the same lines uncompressed. Each autosave appends the entries
+changed since the previous one and syncs the file, so at most one autosave interval of
+work is lost on a crash. Later lines override earlier ones, and a truncated last line
+is skipped on load.
+"""
+import os
+import io
+import gzip
+import json
+import uuid
+from time import time
+
+import pandas as pd
+
+from utils.text import preprocess_data
+from utils.qa_store import build_qa_store, qa_store_from_entries
+from utils.globals import QA_AUTOSAVE_DIR, QA_AUTOSAVE_RETENTION
+
+
+SAVE_FORMAT = 'rpgpt-qa'
+SAVE_VERSION = 2
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def save_header(settings, catalog_fingerprint):
+    return {
+        'format': SAVE_FORMAT,
+        'version': SAVE_VERSION,
+        'settings': preprocess_data(settings or {}),
+        'catalog': catalog_fingerprint,
+    }
+
+
+def entry_lines(answers):
+    """
+    Save file lines of a pd.Series of answers indexed by question_id.
+    """
+    for question_id, answer in zip(answers.index, answers.to_numpy()):
+        yield json.dumps({'question_id': str(question_id), 'answer': answer}, ensure_ascii=False) + '\n'
+
+
+def encode_save(store, settings, catalog_fingerprint):
+    """
+    Gzipped save file of the answered questions of a Q&A store.
+    """
+    answers = store['answer'][store['answer'] != ""]
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6, mtime=0) as f:
+        f.write((json.dumps(save_header(settings, catalog_fingerprint)) + '\n').encode('utf-8'))
+        for line in entry_lines(answers):
+            f.write(line.encode('utf-8'))
+    return buffer.getvalue()
+
+
+def read_save(data):
+    """
+    Read a save file, gzipped or not, or a legacy JSON save file.
+
+    :param data: Bytes of the file
+    :return: (header, entries) where header holds 'settings' and 'catalog'
+    """
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    text = data.decode('utf-8')
+
+    first_line, _, rest = text.partition('\n')
+    try:
+        header = json.loads(first_line)
+    except ValueError:
+        header = None
+
+    if not isinstance(header, dict) or header.get('format') != SAVE_FORMAT:
+        # legacy save file, {'settings': {...}, 'qa': [{'question_id', 'question', 'answer'}, ...]}
+        qa_data = json.loads(text)
+        return {'settings': qa_data.get('settings', {}), 'catalog': None}, qa_data.get('qa', [])
+
+    entries = []
+    for line in rest.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # truncated by a crash while appending
+        if 'format' in record:
+            header = record  # settings changed while autosaving
+        elif 'question_id' in record:
+            entries.append(record)
+    return header, entries
+
+
+def restore_qa_store(entries, filtered_df, catalog_df):
+    """
+    Q&A store of the filtered questions with the answers of a save file.
+    Saved answers of questions outside the filters are kept, with their question text
+    taken from the catalog when the save file does not hold it.
+    """
+    saved = qa_store_from_entries(entries)
+    store = build_qa_store(filtered_df, previous=saved)
+
+    extra = saved.index.difference(store.index)
+    if len(extra):
+        in_catalog = catalog_df[catalog_df['question_number'].astype(str).isin(extra)]
+        extra_store = build_qa_store(in_catalog, previous=saved)
+        orphans = saved.loc[extra.difference(extra_store.index)]
+        store = pd.concat([store, extra_store, orphans])
+    return store
+
+
+
+#---
+# Autosave
+#---
+
+
+def autosave_path(recovery_code, autosave_dir=QA_AUTOSAVE_DIR):
+    """
+    Journal of a recovery code, which must be a UUID so it cannot name another path.
+    """
+    return os.path.join(autosave_dir, f"{uuid.UUID(str(recovery_code))}.ndjson")
+
+
+def prune_autosaves(autosave_dir=QA_AUTOSAVE_DIR, max_age=QA_AUTOSAVE_RETENTION):
+    """
+    Delete journals not written to for max_age seconds.
+    """
+    if not os.path.isdir(autosave_dir):
+        return 0
+    pruned = 0
+    for name in os.listdir(autosave_dir):
+        path = os.path.join(autosave_dir, name)
+        try:
+            if time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                pruned += 1
+        except OSError:
+            pass
+    return pruned
+
+
+class QAAutosave:
+    """
+    Incremental autosave of one session's Q&A store.
+
+    Remembers the answers last written, so each write only appends the entries
+    changed since, including cleared answers. The journal is rewritten with the
+    answered entries only once superseded lines outnumber them.
+    """
+    def __init__(self, recovery_code, autosave_dir=QA_AUTOSAVE_DIR):
+        self.recovery_code = str(recovery_code)
+        self.path = autosave_path(recovery_code, autosave_dir)
+        self.autosave_dir = autosave_dir
+        self.saved = pd.Series(dtype=object)
+        self.header = None
+        self.lines = 0
+        self.last_write = None
+
+    def write(self, store, settings, catalog_fingerprint):
+        """
+        Append the changed entries of store to the journal.
+        Returns the number of entries written.
+        """
+        answers = store['answer']
+        if self.header is None and not (answers != "").any():
+            return 0  # no journal until something is answered
+        previous = self.saved.reindex(answers.index).fillna('')
+        changed = answers[answers.to_numpy() != previous.to_numpy()]
+        header = save_header(settings, catalog_fingerprint)
+        if changed.empty and header == self.header:
+            return 0
+
+        if self.lines > 2 * len(answers) + 100:
+            self._compact(answers, header)
+        else:
+            if self.header is None:
+                os.makedirs(self.autosave_dir, exist_ok=True)
+                prune_autosaves(self.autosave_dir)
+            lines = [json.dumps(header) + '\n'] if header != self.header else []
+            lines += entry_lines(changed)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.lines += len(lines)
+
+        self.saved = answers.copy()
+        self.header = header
+        self.last_write = time()
+        return len(changed)
+
+    def _compact(self, answers, header):
+        answered = answers[answers != ""]
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            f.writelines(entry_lines(answered))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.lines = len(answered) + 1
+
+
+def read_autosave(recovery_code, autosave_dir=QA_AUTOSAVE_DIR):
+    """
+    (header, entries) of the journal of a recovery code, or None when there is none.
+    """
+    try:
+        with open(autosave_path(recovery_code, autosave_dir), 'rb') as f:
+            return read_save(f.read())
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,103 @@
+import pandas as pd
+
+
+# Columns of the Q&A store, indexed by question_id
+QA_COLUMNS = ['question', 'sector', 'module_name', 'answer']
+
+
+def empty_qa_store():
+    """
+    Empty Q&A store.
+    """
+    return pd.DataFrame(
+        {col: pd.Series(dtype=object) for col in QA_COLUMNS},
+        index=pd.Index([], dtype=object, name='question_id'),
+    )
+
+
+def as_qa_store(qa_cache):
+    """
+    Coerce a qa_cache into the columnar Q&A store.
+    Accepts None, an existing store, or the legacy dict format.
+    Example:
+
+    >>> as_qa_store({'1.1': {'question': 'In which language...', 'answer': 'English'}})  # doctest: +NORMALIZE_WHITESPACE
+                             question sector module_name   answer
+    question_id
+    1.1          In which language...                     English
+    """
+    if qa_cache is None:
+        return empty_qa_store()
+    if isinstance(qa_cache, pd.DataFrame):
+        return qa_cache
+    entries = [{'question_id': question_id, **entry} for question_id, entry in qa_cache.items()]
+    return qa_store_from_entries(entries)
+
+
+def build_qa_store(filtered_df, previous=None):
+    """
+    Build the Q&A store for the filtered questions in one vectorized pass.
+    Answers of questions already in the previous store are retained.
+
+    :param filtered_df: Filtered question catalog
+    :param previous: Previous Q&A store or legacy qa_cache dict
+    """
+    store = pd.DataFrame(
+        {
+            'question': filtered_df['2024_question'].to_numpy(dtype=object),
+            'sector': filtered_df['sector'].astype(str).to_numpy(dtype=object),
+            'module_name': filtered_df['module_name'].astype(str).to_numpy(dtype=object),
+        },
+        index=pd.Index(filtered_df['question_number'].astype(str).to_numpy(dtype=object), name='question_id'),
+    )
+    store = store[~store.index.duplicated(keep='last')]
+
+    previous = as_qa_store(previous)
+    answers = previous['answer'][~previous.index.duplicated(keep='last')]
+    store['answer'] = answers.reindex(store.index).fillna('').to_numpy(dtype=object)
+    return store
+
+
+def qa_store_from_entries(entries):
+    """
+    Build the Q&A store from a list of entries, as found in Q&A save files.
+    Example:
+
+    >>> qa_store_from_entries([{'question_id': '1.1', 'question': 'In which language...', 'answer': 'English'}])  # doctest: +NORMALIZE_WHITESPACE
+                             question sector module_name   answer
+    question_id
+    1.1          In which language...                     English
+    """
+    store = pd.DataFrame(list(entries), columns=['question_id'] + QA_COLUMNS)
+    store['question_id'] = store['question_id'].astype(str)
+    store = store.set_index('question_id')
+    store = store[~store.index.duplicated(keep='last')]
+    return store.fillna('').astype(object)
+
+
+def qa_store_to_entries(store, columns=('question', 'answer')):
+    """
+    List of entries of the Q&A store, as written to Q&A save files.
+    Example:
+
+    >>> store = qa_store_from_entries([{'question_id': '1.1', 'question': 'In which language...', 'answer': 'English'}])
+    >>> qa_store_to_entries(store)
+    [{'question_id': '1.1', 'question': 'In which language...', 'answer': 'English'}]
+    """
+    return store[list(columns)].reset_index().to_dict('records')
+
+
+def update_answers(store, answers):
+    """
+    Write a batch of answers into the Q&A store in one vectorized assignment.
+    Only answers that differ from the stored ones are written.
+
+    :param answers: pd.Series of answers indexed by question_id
+    :return: Number of answers changed
+    """
+    answers = answers.fillna('').astype(str)
+    answers = answers[answers.index.isin(store.index)]
+    changed = answers[answers.to_numpy() != store.loc[answers.index, 'answer'].to_numpy()]
+    if not changed.empty:
+        store.loc[changed.index, 'answer'] = changed.to_numpy(dtype=object)
+    return len(changed)
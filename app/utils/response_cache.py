@@ -0,0 +1,133 @@
+import streamlit as st
+
+import re
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.retrieval import normalize_query
+from utils.globals import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY
+
+
+def context_hash(messages):
+    """
+    Hash of the messages before the prompt: system prompt with the retrieved context, and chat history.
+    """
+    digest = hashlib.sha256()
+    for msg in messages:
+        digest.update(f"{msg.type}\x00{msg.content}\x01".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def response_key(model, prompt, context):
+    return hashlib.sha256(f"{model}\x00{context}\x00{normalize_query(prompt)}".encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread safe LRU cache of LLM answers with a time to live.
+
+    Answers are keyed by (model, context hash, normalized prompt). When entries carry the
+    embedding of their prompt, a question missing the exact key can reuse the answer of a
+    near duplicate question asked with the same model and context.
+    """
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, similarity=RESPONSE_CACHE_SIMILARITY):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model, prompt, context, embedding=None):
+        """
+        Cached answer of a prompt, or None.
+        :param embedding: Embedding of the prompt, enables the near duplicate lookup
+        """
+        key = response_key(model, prompt, context)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None and embedding is not None and self.similarity is not None:
+                entry = self._most_similar(model, context, embedding)
+                if entry is not None:
+                    self.similar_hits += 1
+            elif entry is not None:
+                self.hits += 1
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry['key'])
+            return entry['response']
+
+    def put(self, model, prompt, context, response, embedding=None):
+        key = response_key(model, prompt, context)
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding /= np.linalg.norm(embedding) or 1.0
+        with self._lock:
+            self._entries[key] = {
+                'key': key,
+                'model': model,
+                'context': context,
+                'response': response,
+                'embedding': embedding,
+                'created': time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return response
+
+    def _expire(self):
+        expired_before = time() - self.ttl
+        for key in [key for key, entry in self._entries.items() if entry['created'] < expired_before]:
+            del self._entries[key]
+
+    def _most_similar(self, model, context, embedding):
+        candidates = [
+            entry for entry in self._entries.values()
+            if entry['embedding'] is not None and entry['model'] == model and entry['context'] == context
+        ]
+        if not candidates:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = np.stack([entry['embedding'] for entry in candidates]) @ query
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.similarity else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """
+    Process wide cache of LLM answers.
+    """
+    return ResponseCache()
+
+
+def replay_response(response):
+    """
+    Stream a cached answer word by word, as st.write_stream expects.
+    """
+    for match in re.finditer(r'\s*\S+|\s+$', response):
+        yield match.group()
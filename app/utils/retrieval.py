@@ -0,0 +1,169 @@
+import streamlit as st
+
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils.tokens import count_tokens
+from utils.timing import span
+from utils.globals import (
+    RETRIEVAL_CACHE_SIZE,
+    RAG_TOP_K,
+    RAG_FETCH_K,
+    RAG_MAX_DISTANCE,
+    RAG_CONTEXT_TOKENS,
+)
+
+
+def normalize_query(query):
+    """
+    Normalize a query so trivially different phrasings share cache entries.
+    Example:
+
+    >>> normalize_query("  What is Scope 3?? ")
+    'what is scope 3'
+    """
+    query = re.sub(r'[^\w\s]', ' ', query.lower())
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def query_hash(query):
+    return hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache bounded by number of entries, with hit/miss counters.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_embedding_cache():
+    """
+    Process wide cache of query embeddings, keyed by (embedding model, query hash).
+    """
+    return LRUCache(RETRIEVAL_CACHE_SIZE)
+
+
+@st.cache_resource(show_spinner=False)
+def get_retrieval_cache():
+    """
+    Process wide cache of retrieval results, keyed by (collection id, collection size, query hash, k, search).
+    """
+    return LRUCache(RETRIEVAL_CACHE_SIZE)
+
+
+def embed_query(embedding, query, cache=None):
+    """
+    Embed a query, through the query embedding cache.
+    The cache is keyed by the normalized query, the model embeds the query as typed.
+
+    :param cache: Query embedding cache, resolved by the caller when called outside the script thread
+    """
+    cache = cache if cache is not None else get_query_embedding_cache()
+    key = (getattr(embedding, 'model', type(embedding).__name__), query_hash(query))
+    vector = cache.get(key)
+    if vector is None:
+        vector = cache.put(key, tuple(embedding.embed_query(query)))
+    return list(vector)
+
+
+def retrieve(vector_db, query, k=RAG_TOP_K, fetch_k=RAG_FETCH_K, use_mmr=True, max_distance=RAG_MAX_DISTANCE, cache=None, embedding_cache=None):
+    """
+    Top k chunks of the vector db for a query, through the retrieval cache.
+
+    :param vector_db: LangChain Chroma vector store
+    :param query: User question
+    :param k: Number of chunks to return
+    :param fetch_k: Number of candidates considered by MMR
+    :param use_mmr: Diversify results with maximal marginal relevance, else rank by similarity
+    :param max_distance: Drop similarity results farther than this distance, None to keep all
+    :param cache: Retrieval cache, and embedding_cache the query embedding cache, resolved by the
+        caller when called from worker threads, where Streamlit cache resources have no script context
+
+    Returns List[Document]
+    """
+    collection = vector_db._collection
+    search = ('mmr', fetch_k) if use_mmr else ('similarity', max_distance)
+    # the collection id changes when a session collection is deleted and created again,
+    # the collection size invalidates cached results once new chunks are indexed
+    key = (str(collection.id), collection.count(), query_hash(query), k, search)
+
+    cache = cache if cache is not None else get_retrieval_cache()
+    docs = cache.get(key)
+    if docs is not None:
+        return docs
+
+    with span('rag.retrieve', k=k, search=search[0]):
+        query_embedding = embed_query(vector_db._embedding_function, query, cache=embedding_cache)
+        if use_mmr:
+            docs = vector_db.max_marginal_relevance_search_by_vector(query_embedding, k=k, fetch_k=fetch_k)
+        else:
+            docs_and_distances = vector_db.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k)
+            docs = [
+                doc for doc, distance in docs_and_distances
+                if max_distance is None or distance <= max_distance
+            ]
+    return cache.put(key, docs)
+
+
+def pack_context(docs, token_budget=RAG_CONTEXT_TOKENS):
+    """
+    Pack retrieved chunks, in rank order, into a context string within a token budget.
+    Chunks that would overflow the budget are skipped.
+    Example:
+
+    >>> from langchain_core.documents import Document
+    >>> docs = [Document(page_content='Scope 3 emissions...', metadata={'source': 'report.pdf', 'page': 2})]
+    >>> pack_context(docs, token_budget=2000)
+    '[1] report.pdf (page 3)\\nScope 3 emissions...'
+    """
+    parts = []
+    used_tokens = 0
+    for rank, doc in enumerate(docs):
+        source = doc.metadata.get('source', 'unknown')
+        if 'page' in doc.metadata:
+            source += f" (page {int(doc.metadata['page']) + 1})"
+        part = f"[{rank + 1}] {source}\n{doc.page_content}"
+        part_tokens = count_tokens(part)
+        if used_tokens + part_tokens > token_budget:
+            continue
+        parts.append(part)
+        used_tokens += part_tokens
+    return "\n\n".join(parts)
+
+
+RAG_SYSTEM_PROMPT = """You answer questions about the documents uploaded by the user.
+Use only the context below. Cite the sources you use by their [number].
+If the context does not contain the answer, say so.
+
+Context:
+{context}"""
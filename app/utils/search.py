@@ -0,0 +1,157 @@
+import streamlit as st
+
+import re
+import math
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from utils.catalog import get_catalog
+from utils.globals import SEARCH_MAX_RESULTS
+
+
+# Catalog columns indexed for full-text search, including the 2023 question numbers they map to
+SEARCH_COLUMNS = [
+    'question_number',
+    '2024_question',
+    'section',
+    'notes_for_changes',
+    '2023_climate_change_question_number',
+    '2023_forests_question_number',
+    '2023_water_security_question_number',
+]
+
+# Words, and numbers with their dots so question numbers like 2.2.1 stay whole
+TOKEN_PATTERN = re.compile(r'[a-z]+|\d+(?:\.\d+)*')
+
+STOPWORDS = frozenset("""
+a an and are as at be by do does for from has have how in into is it its of on or
+that the this to was were what when which who with your you
+""".split())
+
+MAX_PREFIX_TERMS = 50  # index terms matched by the last, possibly unfinished, query word
+
+
+def tokenize(text):
+    """
+    Example:
+
+    >>> tokenize("Provide details of C-CE0.7 targets")
+    ['provide', 'details', 'of', 'c', 'ce', '0.7', 'targets']
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def query_terms(query):
+    """
+    Words of a search query without stopwords, and whether the last one may be unfinished.
+    """
+    terms = [term for term in tokenize(query) if term not in STOPWORDS]
+    as_prefix = bool(terms) and not query[-1:].isspace()
+    return terms, as_prefix
+
+
+class BM25Index:
+    """
+    Inverted index of short texts ranked with Okapi BM25.
+
+    Each term maps to the positions of the texts containing it and their precomputed
+    BM25 weights, so a search only adds up the postings of its few query terms into
+    one score array. The last query word also matches as a prefix, for search as you type.
+    """
+    def __init__(self, texts, k1=1.5, b=0.75):
+        doc_terms = [Counter(term for term in tokenize(text) if term not in STOPWORDS) for text in texts]
+        doc_lengths = np.array([sum(terms.values()) for terms in doc_terms], dtype=np.float32)
+        self.size = len(doc_terms)
+
+        postings = defaultdict(lambda: ([], []))
+        for position, terms in enumerate(doc_terms):
+            for term, count in terms.items():
+                postings[term][0].append(position)
+                postings[term][1].append(count)
+
+        length_norm = k1 * (1 - b + b * doc_lengths / max(doc_lengths.mean(), 1.0)) if self.size else doc_lengths
+        self._postings = {}
+        for term, (positions, counts) in postings.items():
+            positions = np.array(positions, dtype=np.int32)
+            counts = np.array(counts, dtype=np.float32)
+            idf = math.log(1 + (self.size - len(positions) + 0.5) / (len(positions) + 0.5))
+            weights = idf * counts * (k1 + 1) / (counts + length_norm[positions])
+            self._postings[term] = (positions, weights.astype(np.float32))
+        self.vocabulary = sorted(self._postings)
+
+    def expand(self, terms, as_prefix):
+        """
+        Index terms matching the query terms, the last one as a prefix when as_prefix.
+        """
+        matched = {term for term in terms if term in self._postings}
+        if as_prefix and terms:
+            prefix = terms[-1]
+            start = bisect_left(self.vocabulary, prefix)
+            for term in self.vocabulary[start:start + MAX_PREFIX_TERMS]:
+                if not term.startswith(prefix):
+                    break
+                matched.add(term)
+        return matched
+
+    def search(self, query, positions=None, limit=SEARCH_MAX_RESULTS):
+        """
+        Positions of the best matching texts, with their scores, best first.
+
+        :param query: Search query
+        :param positions: Restrict results to these positions, e.g. the filtered questions
+        :param limit: Maximum number of results
+        """
+        terms, as_prefix = query_terms(query)
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in self.expand(terms, as_prefix):
+            term_positions, weights = self._postings[term]
+            scores[term_positions] += weights
+
+        if positions is None:
+            candidates = np.flatnonzero(scores)
+        else:
+            positions = np.asarray(positions, dtype=np.int64)
+            candidates = positions[scores[positions] > 0]
+        order = np.argsort(-scores[candidates], kind='stable')[:limit]
+        return candidates[order], scores[candidates[order]]
+
+
+def highlight(text, query, markup=':orange-background[{}]'):
+    """
+    Mark the words of a text matching a search query, in Streamlit markdown.
+    Example:
+
+    >>> highlight("Scope 3 emissions", "emis")
+    'Scope 3 :orange-background[emissions]'
+    """
+    terms, as_prefix = query_terms(query)
+    if not terms:
+        return text
+    exact = set(terms)
+    prefix = terms[-1] if as_prefix else None
+
+    parts = []
+    last_end = 0
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if token in exact or (prefix is not None and token.startswith(prefix)):
+            parts.append(text[last_end:match.start()])
+            parts.append(markup.format(text[match.start():match.end()]))
+            last_end = match.end()
+    parts.append(text[last_end:])
+    return ''.join(parts)
+
+
+@st.cache_resource(show_spinner=False)
+def get_question_index(fingerprint):
+    """
+    Process wide search index of the question catalog, rebuilt when the catalog fingerprint changes.
+    Positions in the index are row positions in the catalog.
+    """
+    df = get_catalog().df
+    texts = df[SEARCH_COLUMNS[0]].astype(str).replace('NaN', '')
+    for col in SEARCH_COLUMNS[1:]:
+        texts = texts + ' ' + df[col].astype(str).replace('NaN', '')
+    return BM25Index(texts.tolist())
@@ -0,0 +1,285 @@
+import streamlit as st
+
+import os
+import io
+import sys
+import pickle
+import shutil
+import threading
+from time import time
+from dataclasses import dataclass
+
+from utils.globals import (
+    SESSION_MEMORY_MAX_BYTES,
+    SESSION_SPILL_DIR,
+    SESSION_SPILL_RETENTION,
+    ACTIVE_SESSION_TTL,
+)
+
+
+# Session state keys that can be written to disk while their page is not open
+SPILLABLE_KEYS = ['filtered_df', 'qa_cache', 'qa_save_file', 'chat_history', 'rag_chat_history']
+
+# Spillable keys used by each page, restored before the page runs and never spilled while it is open
+PAGE_STATE_KEYS = {
+    'Get Questions': ['filtered_df', 'qa_cache'],
+    'Read Question': ['filtered_df', 'qa_cache', 'qa_save_file'],
+    'Review Answer': ['filtered_df', 'qa_cache'],
+    'AI Chat': ['chat_history'],
+    'RAG Chat': ['rag_chat_history'],
+}
+
+# Keys referencing process wide objects, measured without what they reference
+# (session collections are accounted by the CollectionManager)
+SHARED_KEYS = ['vector_db']
+
+# Items measured per container, larger containers are extrapolated from them
+SIZE_SAMPLE = 100
+
+
+def estimate_size(value, depth=3, _seen=None):
+    """
+    Estimated bytes held by a value, including what it references.
+    DataFrames are measured with their string contents, large containers are
+    sampled, and object attributes are followed depth levels deep.
+    Example:
+
+    >>> estimate_size(b'x' * 1024) >= 1024  # the payload plus the object header
+    True
+    """
+    _seen = set() if _seen is None else _seen
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    # pandas and numpy are not imported here, values can only be theirs once they are loaded
+    pd = sys.modules.get('pandas')
+    np = sys.modules.get('numpy')
+    if pd is not None and isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if pd is not None and isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if np is not None and isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+    if isinstance(value, io.BytesIO) and not value.closed:
+        # uploads share their buffer with the upload manager, which getsizeof does not count
+        position = value.tell()
+        length = value.seek(0, io.SEEK_END)
+        value.seek(position)
+        return sys.getsizeof(value) + length
+    if isinstance(value, memoryview):
+        return value.nbytes
+
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        items = list(zip(range(SIZE_SAMPLE), value.items()))
+        sampled = sum(estimate_size(k, depth - 1, _seen) + estimate_size(v, depth - 1, _seen) for _, (k, v) in items)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(zip(range(SIZE_SAMPLE), value))
+        sampled = sum(estimate_size(v, depth - 1, _seen) for _, v in items)
+    elif hasattr(value, '__dict__'):
+        return size + estimate_size(vars(value), depth - 1, _seen)
+    else:
+        return size
+    return size + (sampled * len(value) // len(items) if items else 0)
+
+
+@dataclass
+class SpilledValue:
+    """Placeholder of a session state value written to disk."""
+    path: str
+    nbytes: int
+
+
+class SessionMemory:
+    """
+    Memory accountant of one session.
+
+    Measures the session state key by key after each run of a page. When the total
+    exceeds max_bytes, the largest spillable keys not used by the open page are
+    pickled to <spill_dir>/<session_id>/ and replaced with a SpilledValue, then
+    read back when a page using them is opened.
+    """
+    def __init__(self, session_id, max_bytes=SESSION_MEMORY_MAX_BYTES, spill_dir=SESSION_SPILL_DIR):
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        self.spill_dir = os.path.join(spill_dir, str(session_id))
+        self.sizes = {}
+        self.total = 0
+        self.spills = 0
+        self.last_seen = time()
+        self._frame_sizes = {}
+
+    def measure(self, session_state):
+        """
+        Estimated bytes of each session state key, largest first.
+        DataFrames are only measured again once replaced or resized, deep measures of
+        their string columns being the costly part of each rerun.
+        """
+        pd = sys.modules.get('pandas')
+        sizes = {}
+        frame_sizes = {}
+        for key in list(session_state.keys()):
+            try:
+                value = session_state[key]
+                if pd is not None and isinstance(value, pd.DataFrame):
+                    signature = (id(value), value.shape)
+                    cached = self._frame_sizes.get(key)
+                    size = cached[1] if cached is not None and cached[0] == signature else estimate_size(value)
+                    frame_sizes[key] = (signature, size)
+                else:
+                    size = estimate_size(value, depth=0 if key in SHARED_KEYS else 3)
+            except Exception:
+                continue  # a widget value may be dropped while measuring
+            sizes[key] = size
+        self._frame_sizes = frame_sizes
+        self.sizes = dict(sorted(sizes.items(), key=lambda item: item[1], reverse=True))
+        self.total = sum(sizes.values())
+        self.last_seen = time()
+        return self.sizes
+
+    def spilled(self, session_state):
+        return {
+            key: session_state[key].nbytes
+            for key in SPILLABLE_KEYS
+            if isinstance(session_state.get(key), SpilledValue)
+        }
+
+    def spill(self, session_state, key):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"{key}.pkl")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(session_state[key], f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        session_state[key] = SpilledValue(path, os.path.getsize(path))
+        self.spills += 1
+
+    def restore(self, session_state, keys):
+        """
+        Read spilled keys back into the session state.
+        Keys whose spill file is gone are removed, so pages start them afresh.
+        """
+        restored = []
+        for key in keys:
+            value = session_state.get(key)
+            if not isinstance(value, SpilledValue):
+                continue
+            try:
+                with open(value.path, 'rb') as f:
+                    session_state[key] = pickle.load(f)
+                os.remove(value.path)
+                restored.append(key)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                print(f"Unable to restore {key} of session {self.session_id}: {e}")
+                del session_state[key]
+        return restored
+
+    def enforce(self, session_state, keep=()):
+        """
+        Spill the largest spillable keys not in keep until the session fits in max_bytes.
+        Returns the spilled keys.
+        """
+        self.measure(session_state)
+        spilled = []
+        candidates = [key for key in self.sizes if key in SPILLABLE_KEYS and key not in keep]
+        for key in candidates:
+            if self.total <= self.max_bytes:
+                break
+            if isinstance(session_state.get(key), SpilledValue):
+                continue
+            try:
+                self.spill(session_state, key)
+            except (OSError, pickle.PicklingError) as e:
+                print(f"Unable to spill {key} of session {self.session_id}: {e}")
+                continue
+            self.total -= self.sizes.pop(key)
+            spilled.append(key)
+        return spilled
+
+    def clear(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class SessionMemoryRegistry:
+    """
+    Process wide registry of the memory accountants of the sessions, so the footprint
+    of concurrent sessions can be compared and summed.
+    Sessions not seen for active_ttl seconds are dropped from the report, and their
+    spill files once they are older than spill_retention seconds.
+    """
+    def __init__(self, active_ttl=ACTIVE_SESSION_TTL, spill_dir=SESSION_SPILL_DIR, spill_retention=SESSION_SPILL_RETENTION):
+        self.active_ttl = active_ttl
+        self.spill_dir = spill_dir
+        self.spill_retention = spill_retention
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None:
+                memory = self._sessions[session_id] = SessionMemory(session_id, spill_dir=self.spill_dir)
+                self._prune()
+            return memory
+
+    def _prune(self):
+        now = time()
+        for session_id in [s for s, memory in self._sessions.items() if now - memory.last_seen > self.active_ttl]:
+            del self._sessions[session_id]
+
+        if not os.path.isdir(self.spill_dir):
+            return
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if name not in self._sessions and now - os.path.getmtime(path) > self.spill_retention:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            now = time()
+            totals = [memory.total for memory in self._sessions.values() if now - memory.last_seen <= self.active_ttl]
+        return {
+            'sessions': len(totals),
+            'total_mb': round(sum(totals) / 2**20, 2),
+            'largest_mb': round(max(totals, default=0) / 2**20, 2),
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_memory_registry():
+    """
+    Process wide registry of session memory accountants.
+    """
+    return SessionMemoryRegistry()
+
+
+def get_session_memory():
+    """
+    Memory accountant of the current session.
+    """
+    return get_session_memory_registry().get(st.session_state['session_id'])
+
+
+def session_memory_report(memory):
+    """
+    Admin report of the session state footprint, largest keys first.
+    """
+    with st.expander(f"Session Memory ({memory.total / 2**20:.1f} MB)"):
+        st.caption(f"Cap {memory.max_bytes / 2**20:.0f} MB, {memory.spills} spills to disk")
+        st.dataframe(
+            [{'key': key, 'KB': round(size / 1024, 1)} for key, size in list(memory.sizes.items())[:20]],
+            hide_index=True,
+            use_container_width=True,
+        )
+        spilled = memory.spilled(st.session_state)
+        if spilled:
+            st.write({'spilled_kb': {key: round(size / 1024, 1) for key, size in spilled.items()}})
+        st.write({'all_sessions': get_session_memory_registry().stats()})
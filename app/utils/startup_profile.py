@@ -0,0 +1,69 @@
+"""
+Import time breakdown of the app startup, or of opening a page.
+
+Run from the app folder:
+    python -m utils.startup_profile                   # modules imported by main.py
+    python -m utils.startup_profile apps.rag_chat     # extra cost of opening RAG Chat
+"""
+import sys
+import subprocess
+from collections import defaultdict
+
+
+# Modules imported by main.py before any page is opened
+STARTUP_MODULES = ['streamlit', 'streamlit.components.v1', 'hydralit', 'utils.globals', 'apps._loading']
+
+# Stacks that should only be imported once the AI Chat or RAG Chat page is opened
+HEAVY_PACKAGES = ['langchain', 'langchain_core', 'langchain_community', 'langchain_openai', 'langchain_anthropic', 'chromadb', 'openai', 'anthropic']
+
+
+def profile_imports(modules, baseline=()):
+    """
+    Import modules in a fresh interpreter with -X importtime.
+    Modules in baseline are imported first and excluded from the breakdown.
+
+    Returns ({top level package: self time in seconds}, total seconds)
+    """
+    code = ''.join(f"import {module}\n" for module in baseline)
+    code += "import sys; sys.stderr.write('--- profile ---\\n')\n"
+    code += ''.join(f"import {module}\n" for module in modules)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    lines = result.stderr.split('--- profile ---\n', 1)[-1].splitlines()
+    by_package = defaultdict(float)
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        by_package[name.strip().split('.')[0]] += int(self_us) / 1e6
+
+    by_package = dict(sorted(by_package.items(), key=lambda item: item[1], reverse=True))
+    return by_package, sum(by_package.values())
+
+
+def main(argv):
+    pages = argv[1:]
+    if pages:
+        by_package, total = profile_imports(pages, baseline=STARTUP_MODULES)
+        print(f"Opening {', '.join(pages)} after startup: {total:.2f}s")
+    else:
+        by_package, total = profile_imports(STARTUP_MODULES)
+        print(f"Startup imports: {total:.2f}s")
+
+    for package, seconds in list(by_package.items())[:20]:
+        print(f"  {package:<30} {seconds:8.3f}s")
+
+    if not pages:
+        heavy = [package for package in HEAVY_PACKAGES if package in by_package]
+        if heavy:
+            print(f"Warning: startup imports AI stacks: {', '.join(heavy)}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
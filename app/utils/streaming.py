@@ -0,0 +1,100 @@
+from time import perf_counter
+
+from utils.tokens import count_tokens
+from utils.globals import STREAM_FRAME_INTERVAL, STREAM_FRAME_CHARS
+
+
+def chunk_text(chunk):
+    """
+    Text of a streamed message chunk. Anthropic chunks may hold a list of content blocks.
+    """
+    content = getattr(chunk, 'content', chunk)
+    if isinstance(content, str):
+        return content
+    return ''.join(
+        block.get('text', '') if isinstance(block, dict) else str(block)
+        for block in content
+    )
+
+
+class StreamMetrics:
+    """
+    Timing of a streamed answer: time to first token and tokens per second.
+    The answer text is kept as a list of parts and joined once.
+    """
+    def __init__(self):
+        self.started_at = perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.chunks = 0
+        self.frames = 0
+        self.tokens = 0
+        self._parts = []
+
+    def add(self, text):
+        if self.first_token_at is None:
+            self.first_token_at = perf_counter()
+        self.chunks += 1
+        self._parts.append(text)
+
+    def finish(self):
+        self.finished_at = perf_counter()
+        self.tokens = count_tokens(self.text)
+
+    @property
+    def text(self):
+        return ''.join(self._parts)
+
+    @property
+    def ttft(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.finished_at is None:
+            return None
+        return self.tokens / max(self.finished_at - self.first_token_at, 1e-6)
+
+    def as_dict(self):
+        return {
+            'ttft': self.ttft,
+            'tokens': self.tokens,
+            'tokens_per_second': self.tokens_per_second,
+            'chunks': self.chunks,
+            'frames': self.frames,
+        }
+
+
+def coalesce_stream(texts, metrics=None, max_interval=STREAM_FRAME_INTERVAL, max_chars=STREAM_FRAME_CHARS):
+    """
+    Merge streamed text pieces into frames, flushed every max_interval seconds or max_chars characters.
+    The first piece is flushed right away so the time to first token is unchanged.
+
+    :param texts: Iterable of text pieces, e.g. one per token
+    :param metrics: StreamMetrics recording the stream, optional
+    """
+    metrics = metrics if metrics is not None else StreamMetrics()
+    buffer = []
+    buffered_chars = 0
+    last_flush = None
+    for text in texts:
+        if not text:
+            continue
+        metrics.add(text)
+        buffer.append(text)
+        buffered_chars += len(text)
+
+        now = perf_counter()
+        if last_flush is None or buffered_chars >= max_chars or now - last_flush >= max_interval:
+            metrics.frames += 1
+            yield ''.join(buffer)
+            buffer = []
+            buffered_chars = 0
+            last_flush = now
+
+    if buffer:
+        metrics.frames += 1
+        yield ''.join(buffer)
+    metrics.finish()
@@ -1,6 +1,8 @@
 import re
 import numpy as np
 
+from utils.timing import timed
+
 def normalize_string(string:str) -> str:
     return re.sub(r'[\s\-_]+', '_', string.lower())
 
@@ -18,10 +20,10 @@ def preprocess_data(data):
     Example:
     
     >>> preprocess_data([1, 2, np.nan])
-    [1, 2, 'NaN']
+    ['1', '2', 'NaN']
 
     >>> preprocess_data({'a': 1, 'b': np.nan})
-    {'a': 1, 'b': 'NaN'}
+    {'a': '1', 'b': 'NaN'}
     """
     if isinstance(data, list):
         return [convert_to_string(val) for val in data]
@@ -31,10 +33,128 @@ def preprocess_data(data):
         return convert_to_string(data)
 
 
-def infer_sector_rows(df, selected_sector_codes):
+# Sector code aliases between the question catalog and the sector code table
+SECTOR_ALIASES = {
+    'FB': 'FB',
+    'FBT': 'FB',
+    'AC': 'AC',
+    'CE': 'CE',
+    'TO - EPM': 'TO-EPM',
+}
+
+
+def normalize_sector_codes(codes):
+    """
+    Strip and resolve aliases of sector codes.
+
+    >>> normalize_sector_codes(['FBT', ' AC'])
+    ['FB', 'AC']
+    """
+    return [SECTOR_ALIASES.get(code.strip(), code.strip()) for code in codes]
+
+
+def parse_sector_cell(row_sectors):
+    """
+    Parse a 'sector' cell of the question catalog.
+    Example:
+
+    >>> parse_sector_cell('All sectors')
+    (True, set(), set())
+
+    >>> is_wildcard, included, excluded = parse_sector_cell('All (except FS, AC, FB, and PF)')
+    >>> is_wildcard, included, sorted(excluded)
+    (True, set(), ['AC', 'FB', 'FS', 'PF'])
+
+    >>> is_wildcard, included, excluded = parse_sector_cell('CN, RE, TO-EPM')
+    >>> is_wildcard, sorted(included), excluded
+    (False, ['CN', 'RE', 'TO-EPM'], set())
+
+    Returns
+    -------
+    tuple of (bool, set, set)
+        Whether the row applies to all sectors, the included codes and the excluded codes.
+    """
+    row_sectors = str(row_sectors)
+    if "All sectors" in row_sectors:
+        return True, set(), set()
+
+    # 'All (except X, Y, and Z)' format
+    if "except" in row_sectors:
+        exclusion_part = row_sectors.split("except")[1].strip("() ")
+        codes = re.split(r',|\band\b', exclusion_part)
+        excluded = set(normalize_sector_codes([code for code in codes if code.strip()]))
+        return True, set(), excluded
+
+    included = set(normalize_sector_codes([code for code in row_sectors.split(',') if code.strip()]))
+    return False, included, set()
+
+
+class SectorIndex:
+    """
+    Precompiled sector membership of the rows of a question catalog.
+
+    Every distinct 'sector' cell is parsed once, and each sector code is mapped
+    to boolean masks of the row positions that include or exclude it.
+    Selecting sectors is then a vectorized OR / AND-NOT over those masks.
+
+    'All (except ...)' rows match every sector they do not exclude, and the 'TO - EPM'
+    code of the sector table matches the 'TO-EPM' cells of the catalog. The per-row
+    parser this replaced matched neither. Run `python -m doctest utils/text.py` from
+    the app folder to check these examples:
+
+    >>> import pandas as pd
+    >>> index = SectorIndex(pd.Series(['All sectors', 'All (except FS)', 'All (except FS and EU)', 'TO, TO-EPM', 'FS']))
+    >>> index.mask(['FS']).nonzero()[0].tolist()
+    [0, 4]
+    >>> index.mask(['EU']).nonzero()[0].tolist()
+    [0, 1]
+    >>> index.mask(['OG']).nonzero()[0].tolist()
+    [0, 1, 2]
+    >>> index.mask(['TO - EPM']).nonzero()[0].tolist()
+    [0, 1, 2, 3]
+    """
+    def __init__(self, sectors):
+        values = sectors.astype(str).to_numpy()
+        self.size = len(values)
+        self.wildcard = np.zeros(self.size, dtype=bool)
+        self.includes = {}
+        self.excludes = {}
+
+        unique_cells, inverse = np.unique(values, return_inverse=True)
+        for cell_idx, cell in enumerate(unique_cells):
+            rows = inverse == cell_idx
+            is_wildcard, included, excluded = parse_sector_cell(cell)
+            if is_wildcard:
+                self.wildcard |= rows
+            for code in included:
+                self.includes.setdefault(code, np.zeros(self.size, dtype=bool))
+                self.includes[code] |= rows
+            for code in excluded:
+                self.excludes.setdefault(code, np.zeros(self.size, dtype=bool))
+                self.excludes[code] |= rows
+
+    def mask(self, selected_sector_codes):
+        """
+        Boolean mask of the rows matching any of the selected sector codes.
+        Wild card rows match unless one of the selected codes is excluded.
+        """
+        included = np.zeros(self.size, dtype=bool)
+        excluded = np.zeros(self.size, dtype=bool)
+        for code in set(normalize_sector_codes(selected_sector_codes)):
+            if code in self.includes:
+                included |= self.includes[code]
+            if code in self.excludes:
+                excluded |= self.excludes[code]
+        return included | (self.wildcard & ~excluded)
+
+
+@timed('filter.infer_sector_rows')
+def infer_sector_rows(df, selected_sector_codes, sector_index=None):
     """
     Infer sector rows based on the selected sector codes.
     Example: 
+
+    >>> infer_sector_rows(df, ['FS', 'OG'])  # doctest: +SKIP
     
     Parameters
     ----------
@@ -42,41 +162,13 @@ def infer_sector_rows(df, selected_sector_codes):
         The input dataframe.
     selected_sector_codes : list of str
         The list of sector codes to match.
+    sector_index : SectorIndex, optional
+        Precompiled index of df['sector']. Built on the fly if not given.
     
     Returns
     -------
     pd.DataFrame
     """
-    alias_mapping = {
-        'FB': 'FB',
-        'FBT': 'FB',
-        'AC': 'AC',
-        'CE': 'CE',
-    }
-
-    def normalize_codes(codes):
-        return [alias_mapping.get(code, code) for code in codes]
-    
-    def sector_row_match(row_sectors):
-        # Handle "wild card" rows
-        if "All sectors" in row_sectors:
-            return True
-
-        # Exclude rows with 'except' clauses that contain selected sectors
-        if "except" in row_sectors:
-            # Split out the excluded sectors in 'All (except X, Y, Z)' format
-            exclusion_part = row_sectors.split("except")[1].strip("() ")
-            excluded_codes = set(normalize_codes([code.strip().replace("and ", "") for code in exclusion_part.split(',')]))
-
-            if any(code in excluded_codes for code in selected_sector_codes):
-                return False
-
-        # Split row sectors and check for any overlap with selected codes
-        row_codes = set(normalize_codes([code.strip() for code in row_sectors.split(',')]))
-        return bool(row_codes.intersection(selected_sector_codes))
-    
-    # Apply the match function across the Sector column
-    selected_sector_codes = normalize_codes(selected_sector_codes)
-    matched_df = df[df['sector'].apply(sector_row_match)]
-    return matched_df
-
+    if sector_index is None or sector_index.size != len(df):
+        sector_index = SectorIndex(df['sector'])
+    return df[sector_index.mask(selected_sector_codes)]
@@ -0,0 +1,276 @@
+"""
+Span timing of the hot paths of the app.
+
+    with span('catalog.load') as attrs:
+        attrs['source'] = 'cache'
+
+    @timed('filter.apply_filters')
+    def apply_filters(...): ...
+
+Every span is added to the process wide SpanRegistry (count, sum, max and a histogram
+per span name), kept in a bounded log of recent spans, and written as a JSON line to the
+'rpgpt.timing' logger. Spans recorded inside collect_spans() are also collected in a list,
+which is how a page run gets its own timing breakdown and how process pool workers send
+their spans back to the app.
+
+Set RPGPT_TIMING_LOG to append the span log to a file, and RPGPT_PROMETHEUS_FILE to write
+the registry in the Prometheus text format after each page run (e.g. for a node exporter
+textfile collector).
+
+Kept free of Streamlit so process pool workers can record spans.
+"""
+import os
+import json
+import logging
+import threading
+from time import time, perf_counter
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from utils.globals import (
+    TIMING_BUCKETS,
+    TIMING_LOG_SIZE,
+    TIMING_LOG_FILE,
+    TIMING_PROMETHEUS_FILE,
+)
+
+
+logger = logging.getLogger('rpgpt.timing')
+if TIMING_LOG_FILE and not logger.handlers:
+    handler = logging.FileHandler(TIMING_LOG_FILE, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# (spans, propagate) of the innermost collect_spans(), and the nesting depth of spans
+_collector = ContextVar('timing_collector', default=None)
+_depth = ContextVar('timing_depth', default=0)
+
+
+class SpanRegistry:
+    """
+    Process wide aggregates of span durations, with a log of the most recent spans.
+    """
+    def __init__(self, buckets=TIMING_BUCKETS, log_size=TIMING_LOG_SIZE):
+        self.buckets = tuple(buckets)
+        self.log = deque(maxlen=log_size)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        seconds = record['seconds']
+        with self._lock:
+            stats = self._stats.get(record['span'])
+            if stats is None:
+                stats = self._stats[record['span']] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            self.log.append(record)
+
+    def stats(self):
+        """
+        {span: {'count', 'total_s', 'mean_ms', 'max_ms'}}, largest total first.
+        """
+        with self._lock:
+            stats = {
+                name: {
+                    'count': s['count'],
+                    'total_s': round(s['sum'], 3),
+                    'mean_ms': round(1000 * s['sum'] / s['count'], 1),
+                    'max_ms': round(1000 * s['max'], 1),
+                }
+                for name, s in self._stats.items()
+            }
+        return dict(sorted(stats.items(), key=lambda item: item[1]['total_s'], reverse=True))
+
+    def recent(self):
+        with self._lock:
+            return list(self.log)
+
+    def prometheus(self):
+        """
+        Registry in the Prometheus text exposition format, one histogram labelled by span.
+        """
+        lines = [
+            '# HELP rpgpt_span_seconds Duration of instrumented spans of the app.',
+            '# TYPE rpgpt_span_seconds histogram',
+        ]
+        with self._lock:
+            for name, s in sorted(self._stats.items()):
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                for bound, count in zip(self.buckets, s['buckets']):
+                    lines.append(f'rpgpt_span_seconds_bucket{{span="{label}",le="{bound}"}} {count}')
+                lines.append(f'rpgpt_span_seconds_bucket{{span="{label}",le="+Inf"}} {s["count"]}')
+                lines.append(f'rpgpt_span_seconds_sum{{span="{label}"}} {s["sum"]:.6f}')
+                lines.append(f'rpgpt_span_seconds_count{{span="{label}"}} {s["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write the Prometheus text to path atomically. Failures are only reported.
+        """
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Unable to write timing metrics to {path}: {e}")
+
+
+REGISTRY = SpanRegistry()
+
+
+def record_span(name, seconds, **attrs):
+    """
+    Record a span measured elsewhere, e.g. time to first token of a stream.
+    """
+    record = {'ts': round(time(), 3), 'span': name, 'seconds': round(seconds, 6), 'depth': _depth.get(), **attrs}
+    collector = _collector.get()
+    if collector is not None:
+        collector[0].append(record)
+        if not collector[1]:
+            return record
+    REGISTRY.record(record)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record, default=str))
+    return record
+
+
+def record_spans(records):
+    """
+    Record spans collected in another process, e.g. returned by a process pool worker.
+    """
+    for record in records:
+        record = dict(record)
+        record_span(record.pop('span'), record.pop('seconds'), **{k: v for k, v in record.items() if k not in ['ts', 'depth']})
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time the enclosed block. Yields the attributes of the span, which the block may add to.
+    The span is recorded even when the block raises, e.g. on a Streamlit rerun.
+    """
+    token = _depth.set(_depth.get() + 1)
+    started_at = perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = perf_counter() - started_at
+        _depth.reset(token)
+        record_span(name, seconds, **attrs)
+
+
+def timed(name=None):
+    """
+    Decorator timing each call of a function as a span, named after the function by default.
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class IterTimer:
+    """
+    Time spent producing the items of an iterator, excluding the time the consumer holds them.
+    Example:
+
+    >>> import time
+    >>> def slow_docs():
+    ...     for page in range(3):
+    ...         time.sleep(0.01)
+    ...         yield page
+    >>> docs = IterTimer(slow_docs())
+    >>> [time.sleep(0.05) for _ in docs] and docs.items
+    3
+    >>> 0.03 <= docs.seconds < 0.15  # the 0.15 s spent by the consumer is excluded
+    True
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0.0
+        self.items = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started_at = perf_counter()
+        try:
+            item = next(self._iterator)
+        finally:
+            self.seconds += perf_counter() - started_at
+        self.items += 1
+        return item
+
+
+@contextmanager
+def collect_spans(propagate=True):
+    """
+    Collect the spans recorded in the enclosed block, in this thread, into a list.
+    With propagate=False they are only collected, e.g. in a worker process that
+    returns them to the app.
+    """
+    spans = []
+    token = _collector.set((spans, propagate))
+    try:
+        yield spans
+    finally:
+        _collector.reset(token)
+
+
+def export_metrics():
+    """
+    Write the registry to RPGPT_PROMETHEUS_FILE, when set.
+    """
+    if TIMING_PROMETHEUS_FILE:
+        REGISTRY.write_prometheus(TIMING_PROMETHEUS_FILE)
+
+
+def timing_report(spans):
+    """
+    Admin report of the spans of a page run, the process wide aggregates and their exports.
+    """
+    import streamlit as st
+
+    total = sum(record['seconds'] for record in spans if record['depth'] == 0)
+    with st.expander(f"Timing ({1000 * total:.0f} ms)"):
+        st.dataframe(
+            [
+                {
+                    'span': '· ' * record['depth'] + record['span'],
+                    'ms': round(1000 * record['seconds'], 1),
+                    **{k: v for k, v in record.items() if k not in ['ts', 'span', 'seconds', 'depth']},
+                }
+                for record in sorted(spans, key=lambda record: record['ts'] - record['seconds'])
+            ],
+            hide_index=True,
+            use_container_width=True,
+        )
+        st.caption('All sessions')
+        st.dataframe(
+            [{'span': name, **stats} for name, stats in REGISTRY.stats().items()],
+            hide_index=True,
+            use_container_width=True,
+        )
+        st.download_button('Download metrics (Prometheus)', REGISTRY.prometheus(), file_name='rpgpt_metrics.prom', mime='text/plain')
+        st.download_button(
+            'Download span log (NDJSON)',
+            ''.join(json.dumps(record, default=str) + '\n' for record in REGISTRY.recent()),
+            file_name='rpgpt_spans.ndjson',
+            mime='application/x-ndjson',
+        )
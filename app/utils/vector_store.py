@@ -0,0 +1,278 @@
+import streamlit as st
+
+import os
+import json
+import threading
+from time import time
+
+from utils.parsing import get_document_hash
+from utils.timing import span
+from utils.globals import (
+    EMBEDDING_BATCH_SIZE,
+    CHROMA_DIR,
+    VECTOR_STORE_MAX_BYTES,
+    ACTIVE_SESSION_TTL,
+)
+
+
+def collection_name_for(session_id):
+    """
+    Name of the Chroma collection of a session.
+    Example:
+        collection_name_for("0b6a3f1e-4d2c-4d38-9a57-5d1c2f1f8e4a")
+        "session_0b6a3f1e-4d2c-4d38-9a57-5d1c2f1f8e4a"
+    """
+    return f"session_{session_id}"
+
+
+class CollectionManager:
+    """
+    Process wide manager of per-session Chroma collections.
+
+    Each session gets one collection, reused across reruns, with its last access
+    time, vector count and estimated size tracked in <persist_directory>/collections.json.
+    Least recently used collections are evicted when the estimated total size
+    exceeds the budget. Collections accessed within active_ttl seconds, or pinned by a
+    background job, are never evicted.
+
+    Server processes sharing the persist directory share the registry: each save merges
+    the changes of this process into the registry on disk, so entries of other processes
+    are kept. Collections missing from the registry are only evicted once they have been
+    seen unregistered for active_ttl seconds, as another process may just have created one.
+    """
+    def __init__(self, persist_directory=CHROMA_DIR, max_bytes=VECTOR_STORE_MAX_BYTES, active_ttl=ACTIVE_SESSION_TTL):
+        import chromadb
+
+        os.makedirs(persist_directory, exist_ok=True)
+        self.persist_directory = persist_directory
+        self.max_bytes = max_bytes
+        self.active_ttl = active_ttl
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        self._registry_path = os.path.join(persist_directory, 'collections.json')
+        self._lock = threading.RLock()
+        self._registry = self._load_registry()
+        self._changed = set()  # names changed or deleted by this process since the last save
+        self._unregistered = {}  # name: first time seen without a registry entry
+        self._pins = {}  # name: number of background jobs using the collection
+
+    def _load_registry(self):
+        try:
+            with open(self._registry_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _merge_registry(self):
+        """
+        Registry on disk with the changes of this process applied.
+        Entries of other processes are taken from disk, including their deletions.
+        """
+        registry = self._load_registry()
+        for name in self._changed:
+            entry = self._registry.get(name)
+            if entry is None:
+                registry.pop(name, None)
+            elif name not in registry or entry.get('last_access', 0) >= registry[name].get('last_access', 0):
+                registry[name] = entry
+        self._registry = registry
+
+    def _save_registry(self):
+        self._merge_registry()
+        tmp_path = f"{self._registry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._registry, f)
+        os.replace(tmp_path, self._registry_path)
+        self._changed.clear()
+
+    def exists(self, session_id):
+        with self._lock:
+            return collection_name_for(session_id) in self._registry
+
+    def open(self, session_id, embedding):
+        """
+        Open, or create, the collection of a session as a LangChain Chroma vector store.
+        """
+        from langchain_community.vectorstores import Chroma
+
+        name = collection_name_for(session_id)
+        with self._lock:
+            vector_db = Chroma(
+                client=self.client,
+                collection_name=name,
+                embedding_function=embedding,
+            )
+            entry = self._registry.setdefault(name, {'session_id': session_id, 'vectors': 0, 'bytes': 0})
+            entry['vectors'] = vector_db._collection.count()
+            entry['last_access'] = time()
+            self._changed.add(name)
+            self._save_registry()
+        return vector_db
+
+    def touch(self, session_id):
+        """
+        Mark the collection of a session as accessed. Returns False if it was evicted.
+        """
+        name = collection_name_for(session_id)
+        with self._lock:
+            self._merge_registry()  # evicted by another process
+            if name not in self._registry:
+                return False
+            self._registry[name]['last_access'] = time()
+            self._changed.add(name)
+            self._save_registry()
+            return True
+
+    def record_add(self, session_id, vectors, nbytes):
+        """
+        Account for vectors added to the collection of a session, then evict over budget.
+        """
+        name = collection_name_for(session_id)
+        with self._lock:
+            entry = self._registry.setdefault(name, {'session_id': session_id, 'vectors': 0, 'bytes': 0})
+            entry['vectors'] += vectors
+            entry['bytes'] += nbytes
+            entry['last_access'] = time()
+            self._changed.add(name)
+            self.evict(protect=[name])
+
+    def pin(self, session_id):
+        """
+        Protect the collection of a session from eviction while a background job reads it.
+        Each pin is undone by one unpin().
+        """
+        name = collection_name_for(session_id)
+        with self._lock:
+            self._pins[name] = self._pins.get(name, 0) + 1
+
+    def unpin(self, session_id):
+        name = collection_name_for(session_id)
+        with self._lock:
+            if self._pins.get(name, 0) <= 1:
+                self._pins.pop(name, None)
+            else:
+                self._pins[name] -= 1
+
+    def release(self, session_id):
+        """
+        Delete the collection of a session, e.g. on logout or cleared uploads.
+        """
+        name = collection_name_for(session_id)
+        with self._lock:
+            self._delete(name)
+            self._save_registry()
+
+    def _delete(self, name):
+        try:
+            self.client.delete_collection(name)
+        except Exception as e:
+            print(f"Unable to delete collection {name}: {e}")
+        self._registry.pop(name, None)
+        self._changed.add(name)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry['bytes'] for entry in self._registry.values())
+
+    def evict(self, protect=()):
+        """
+        Delete least recently used, inactive collections until the total size fits the budget.
+        Collections unknown to the registry for active_ttl seconds, e.g. from older versions,
+        are evicted first.
+        Returns the names of the evicted collections.
+        """
+        evicted = []
+        with self._lock:
+            protect = {*protect, *self._pins}
+            self._merge_registry()
+            now = time()
+            unregistered = {}
+            for collection in self.client.list_collections():
+                name = collection.name
+                if name in self._registry or name in protect:
+                    continue
+                unregistered[name] = self._unregistered.get(name, now)
+                if now - unregistered[name] > self.active_ttl:
+                    self._delete(name)
+                    evicted.append(name)
+                    del unregistered[name]
+            self._unregistered = unregistered
+
+            candidates = sorted(
+                (
+                    (entry.get('last_access', 0), name)
+                    for name, entry in self._registry.items()
+                    if name not in protect and now - entry.get('last_access', 0) > self.active_ttl
+                ),
+            )
+            total = self.total_bytes()
+            for _, name in candidates:
+                if total <= self.max_bytes:
+                    break
+                total -= self._registry[name]['bytes']
+                self._delete(name)
+                evicted.append(name)
+
+            self._save_registry()
+        if evicted:
+            print(f"Evicted collections: {evicted}")
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'collections': len(self._registry),
+                'vectors': sum(entry['vectors'] for entry in self._registry.values()),
+                'bytes': self.total_bytes(),
+                'max_bytes': self.max_bytes,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_collection_manager():
+    """
+    Process wide collection manager.
+    """
+    return CollectionManager()
+
+
+
+def index_chunks(vector_db, session_id, chunks, embeddings, processed_chunks, manager=None):
+    """
+    Index embedded chunks in the session vector db, skipping chunks already indexed.
+    Returns the new chunks.
+
+    :param vector_db: LangChain Chroma vector store of the session
+    :param chunks: List[Document]
+    :param embeddings: Embeddings of the chunks, in the same order
+    :param processed_chunks: Set of the hashes of the chunks indexed in the session, updated in place
+    :param manager: CollectionManager accounting for the added vectors, resolved by the caller when
+        called from a background thread, where Streamlit cache resources have no script context
+    """
+    unique_chunks = []
+    unique_embeddings = []
+    for chunk, chunk_embedding in zip(chunks, embeddings):
+        chunk_hash = get_document_hash(chunk)
+        if chunk_hash not in processed_chunks:
+            processed_chunks.add(chunk_hash)
+            unique_chunks.append((chunk_hash, chunk))
+            unique_embeddings.append(chunk_embedding)
+
+    if not unique_chunks:
+        return []
+
+    added_bytes = 0
+    with span('vector_store.write', chunks=len(unique_chunks)):
+        for i in range(0, len(unique_chunks), EMBEDDING_BATCH_SIZE):
+            batch = unique_chunks[i:i + EMBEDDING_BATCH_SIZE]
+            batch_embeddings = [list(map(float, vector)) for vector in unique_embeddings[i:i + EMBEDDING_BATCH_SIZE]]
+            vector_db._collection.upsert(
+                ids=[chunk_hash for chunk_hash, _ in batch],
+                embeddings=batch_embeddings,
+                documents=[chunk.page_content for _, chunk in batch],
+                metadatas=[chunk.metadata for _, chunk in batch],
+            )
+            added_bytes += sum(4 * len(vector) + len(chunk.page_content) for vector, (_, chunk) in zip(batch_embeddings, batch))
+    manager = manager if manager is not None else get_collection_manager()
+    manager.record_add(session_id, len(unique_chunks), added_bytes)
+
+    return [chunk for _, chunk in unique_chunks]